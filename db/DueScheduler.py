@@ -0,0 +1,121 @@
+import asyncio
+import datetime as dt
+import logging
+import typing
+
+import sqlalchemy as sa
+
+from db.db import session_maker
+from db.tables import PlatfeBothSidedBox, PlatfeDuty, SETTLE_CHUNK_SIZE
+from utils import due_queue
+
+# на сколько вперёд строки с ближайшими сроками загружаются в память
+SCHEDULER_HORIZON = dt.timedelta(minutes=10)
+# через сколько повторить расчёт, если он упал с ошибкой
+SCHEDULER_RETRY_DELAY = dt.timedelta(minutes=1)
+
+log = logging.getLogger(__name__)
+
+KINDS = {
+    "duty": PlatfeDuty,
+    "box": PlatfeBothSidedBox,
+}
+
+
+class DueScheduler:
+    # Фоновая оплата пошлин и аренды коробок. Срок следующей оплаты хранится в индексированном
+    # next_due_timestamp, в память попадают только строки со сроком в пределах горизонта,
+    # а цикл спит до ближайшего срока. После перезапуска расчёт продолжается с сохранённых сроков.
+    def __init__(self, horizon: dt.timedelta = SCHEDULER_HORIZON):
+        self.horizon = horizon
+        # когда повторить backfill; None — строк без срока больше нет
+        self.backfill_at: typing.Optional[dt.datetime] = dt.datetime.now()
+
+    async def run(self):
+        while True:
+            now = dt.datetime.now()
+            if self.backfill_at is not None and now >= self.backfill_at:
+                self.backfill_at = None if await self.backfill() else now + SCHEDULER_RETRY_DELAY
+            if due_queue.loaded_until is None or now + self.horizon / 2 >= due_queue.loaded_until:
+                await self.load(now)
+            if due_queue.loaded_until is None:
+                await asyncio.sleep(SCHEDULER_RETRY_DELAY.total_seconds())
+                continue
+
+            due = due_queue.pop_due(now)
+            if due:
+                for kind, ids in due.items():
+                    await self.settle(kind, ids, now)
+                continue
+
+            wake = due_queue.loaded_until - self.horizon / 2
+            next_due = due_queue.next_due()
+            if next_due is not None and next_due < wake:
+                wake = next_due
+            if self.backfill_at is not None and self.backfill_at < wake:
+                wake = self.backfill_at
+            due_queue.wakeup.clear()
+            try:
+                await asyncio.wait_for(due_queue.wakeup.wait(), max((wake - now).total_seconds(), 0))
+            except asyncio.TimeoutError:
+                pass
+
+    async def load(self, now: dt.datetime):
+        until = now + self.horizon
+        try:
+            async with session_maker() as session:
+                rows = {kind: await model.get_due_ids(session, until) for kind, model in KINDS.items()}
+        except Exception as e:
+            print(e)
+            return
+        for kind, ids in rows.items():
+            for row_id, due in ids:
+                due_queue.push(kind, row_id, due)
+        due_queue.loaded_until = until
+
+    async def settle(self, kind: str, ids: typing.List[int], now: dt.datetime):
+        model = KINDS[kind]
+        for i in range(0, len(ids), SETTLE_CHUNK_SIZE):
+            chunk = ids[i:i + SETTLE_CHUNK_SIZE]
+            try:
+                async with session_maker() as session:
+                    r = await session.execute(sa.select(model).where(model.id.in_(chunk)))
+                    rows = r.scalars().all()
+                    if kind == "box":
+                        rows = [b for b in rows if not b.disabled and not b.blocked]
+                    next_due = await model.settle(session, rows, now)
+                    await session.commit()
+            except Exception as e:
+                print(e)
+                for row_id in chunk:
+                    due_queue.schedule(kind, row_id, now + SCHEDULER_RETRY_DELAY)
+                continue
+
+            for row_id, due in next_due.items():
+                if kind == "duty":
+                    due = due[1]
+                due_queue.schedule(kind, row_id, due)
+
+    async def backfill(self) -> bool:
+        # строки, созданные до появления next_due_timestamp, рассчитываются один раз и получают срок;
+        # False, если что-то не удалось и backfill нужно повторить позже
+        done = True
+        for kind, model in KINDS.items():
+            after_id = 0
+            while True:
+                try:
+                    async with session_maker() as session:
+                        rows = await model.get_unscheduled_chunk(session, after_id)
+                        if not rows:
+                            break
+                        after_id = rows[-1].id
+                        await model.settle(session, rows)
+                        await session.commit()
+                except Exception:
+                    log.exception("backfill of %s after id %d failed, retrying in %s", kind, after_id, SCHEDULER_RETRY_DELAY)
+                    done = False
+                    break
+        return done
+
+
+due_scheduler = DueScheduler()
@@ -0,0 +1,68 @@
+import asyncio
+import typing
+
+from db.db import session_maker
+from db.tables import PlatfeAccounts, PlatfeUser
+
+# включает групповой коммит переводов из PayHandler
+GROUP_COMMIT = False
+# сколько ждать попутных переводов после первого в окне
+MAX_COMMIT_DELAY = 0.005
+# сколько переводов максимум коммитится вместе
+MAX_COMMIT_BATCH = 256
+
+
+class TransferCommitter:
+    # Переводы из разных соединений собираются в короткие окна и проводятся одной транзакцией:
+    # один SELECT ... FOR UPDATE, один UPDATE балансов, одна вставка в лог и один коммит на окно.
+    # Вызывающий получает код PAY_STATUS только после того, как общий коммит прошёл.
+    def __init__(self, enabled: bool = GROUP_COMMIT, max_delay: float = MAX_COMMIT_DELAY,
+                 max_batch: int = MAX_COMMIT_BATCH):
+        self.enabled = enabled
+        self.max_delay = max_delay
+        self.max_batch = max_batch
+        self.queue: typing.List[typing.Tuple[tuple, asyncio.Future]] = []
+        self.full = asyncio.Event()
+        self.task: typing.Optional[asyncio.Task] = None
+
+    async def submit(self, usr: PlatfeUser, acc1_id: int, acc2_id: int, count: int) -> int:
+        # передаются id, а не объекты: счета перечитываются и блокируются в транзакции окна
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.queue.append(((usr, acc1_id, acc2_id, count), future))
+        if len(self.queue) >= self.max_batch:
+            self.full.set()
+        if self.task is None or self.task.done():
+            self.task = loop.create_task(self.run())
+        return await future
+
+    async def run(self):
+        while self.queue:
+            if len(self.queue) < self.max_batch:
+                try:
+                    await asyncio.wait_for(self.full.wait(), self.max_delay)
+                except asyncio.TimeoutError:
+                    pass
+            self.full.clear()
+
+            batch, self.queue = self.queue[:self.max_batch], self.queue[self.max_batch:]
+            if len(self.queue) >= self.max_batch:
+                self.full.set()
+            await self.commit(batch)
+
+    async def commit(self, batch: typing.List[typing.Tuple[tuple, asyncio.Future]]):
+        try:
+            async with session_maker() as session:
+                statuses = await PlatfeAccounts.transfer_batch(session, [item for item, _ in batch])
+                if 0 in statuses:
+                    await session.commit()
+        except Exception as e:
+            print(e)
+            statuses = [-5] * len(batch)
+
+        for (_, future), status in zip(batch, statuses):
+            if not future.done():
+                future.set_result(status)
+
+
+transfer_committer = TransferCommitter()
@@ -0,0 +1,9 @@
+-- Хэш токена вместо открытого токена и индекс по имени для входа (PlatfeUser.check_auth).
+-- create_all не меняет существующие таблицы, на старой базе выполнить до запуска новой версии:
+
+ALTER TABLE platfe_users
+    ADD COLUMN token_hash VARCHAR(64) NULL,
+    MODIFY token VARCHAR(200) COLLATE utf8mb4_0900_as_cs NULL,
+    ADD INDEX ix_platfe_users_name (name);
+
+-- Открытые токены существующих пользователей заменяются хэшем при их первом входе.
@@ -0,0 +1,14 @@
+-- Сроки следующей оплаты для планировщика (db/DueScheduler.py).
+-- create_all не меняет существующие таблицы, поэтому до запуска новой версии на старой базе выполнить:
+
+ALTER TABLE platfe_duty
+    ADD COLUMN next_due_timestamp DATETIME NULL,
+    ADD INDEX ix_platfe_duty_next_due_timestamp (next_due_timestamp);
+
+ALTER TABLE platfe_both_sided_box
+    ADD COLUMN next_due_timestamp DATETIME NULL,
+    ADD INDEX ix_platfe_both_sided_box_next_due_timestamp (next_due_timestamp),
+    MODIFY period DATETIME NULL,
+    MODIFY tax_amount INT NOT NULL DEFAULT 0;
+
+-- Значения next_due_timestamp для уже существующих строк заполняет DueScheduler.backfill при первом запуске.
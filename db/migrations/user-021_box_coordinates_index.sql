@@ -0,0 +1,5 @@
+-- Индекс для поиска коробки по блоку и проверки занятости точки при регистрации.
+-- create_all не создаёт индексы в существующих таблицах, на старой базе выполнить:
+
+ALTER TABLE platfe_both_sided_box
+    ADD INDEX ix_platfe_both_sided_box_world_xyz (world_id, x, y, z);
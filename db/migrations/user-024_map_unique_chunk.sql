@@ -0,0 +1,31 @@
+-- Уникальный ключ (world, chunk_x, chunk_y), на него опирается INSERT ... ON DUPLICATE KEY UPDATE в PlatfeMap.upload.
+-- create_all не добавляет ключи в существующие таблицы. Без ключа выгрузка молча плодит дубли чанков,
+-- поэтому на старой базе выполнить до запуска новой версии. Из дублей остаётся самая новая строка (наибольший id),
+-- подтверждения удаляемых строк переносятся на неё.
+
+START TRANSACTION;
+
+UPDATE platfe_map_confirmations c
+    JOIN platfe_map m ON m.id = c.transaction_id
+    JOIN (
+        SELECT world, chunk_x, chunk_y, MAX(id) AS keep_id
+        FROM platfe_map
+        GROUP BY world, chunk_x, chunk_y
+        HAVING COUNT(*) > 1
+    ) k ON k.world = m.world AND k.chunk_x = m.chunk_x AND k.chunk_y = m.chunk_y
+SET c.transaction_id = k.keep_id
+WHERE m.id <> k.keep_id;
+
+DELETE m FROM platfe_map m
+    JOIN (
+        SELECT world, chunk_x, chunk_y, MAX(id) AS keep_id
+        FROM platfe_map
+        GROUP BY world, chunk_x, chunk_y
+        HAVING COUNT(*) > 1
+    ) k ON k.world = m.world AND k.chunk_x = m.chunk_x AND k.chunk_y = m.chunk_y
+WHERE m.id <> k.keep_id;
+
+COMMIT;
+
+ALTER TABLE platfe_map
+    ADD UNIQUE KEY uq_platfe_map_world_chunk (world, chunk_x, chunk_y);
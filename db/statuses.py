@@ -1,5 +1,6 @@
 
 PAY_STATUS = {
+    -8: "Error: account not found.",
     -7: "Error: cycle pay.",
     -6: "Error: You don't owner.",
     -5: "Error: DB error.",
@@ -10,6 +11,21 @@ PAY_STATUS = {
     0: "Payment accepted."
 }
 
+TRADE_STATUS = {
+    -11: "Error: not enough items in the box.",
+    -10: "Error: box doesn't trade in this direction.",
+    -9: "Error: box blocked.",
+    -8: "Error: box not found.",
+    -7: "Error: trade with own box.",
+    -6: "Error: You don't owner.",
+    -5: "Error: DB error.",
+    -4: "Error: account blocked.",
+    -3: "Error: box trades in other currency.",
+    -2: "Error: there are insufficient funds in the account.",
+    -1: "Error: count <= 0.",
+    0: "Trade accepted."
+}
+
 BOX_SIDED_CREATION_STATUSES = {
     -4: "This box was created latter.",
     -3: "Link payer account to duty failed.",
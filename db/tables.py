@@ -1,14 +1,22 @@
-import asyncio
 import datetime as dt
+import hashlib
+import hmac
 import typing
 
 import sqlalchemy as sa
 
+from sqlalchemy.dialects.mysql import insert as mysql_insert
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy.orm import DeclarativeBase, mapped_column
+from sqlalchemy.orm import DeclarativeBase, Session, mapped_column
+from sqlalchemy.orm.attributes import set_committed_value
 from sqlalchemy.orm import Mapped
 from passlib import pwd
-import fnmatch as fn
+
+from utils import status_snapshot, permission_cache, principals, auth_cache, due_queue, references, registry_accounts, box_index, \
+    tile_hashes, tile_cache
+from utils.BoxIndex import BoxRef
+from utils.PrincipalRegistry import Principal
+from utils.ReferenceCache import CurrencyRef, WorldRef
 
 create_string_param = {"collation": "utf8mb4_0900_as_cs"}
 
@@ -17,38 +25,105 @@ class Base(DeclarativeBase):
     pass
 
 
+def after_commit(session: AsyncSession, callback: typing.Callable[[], None]):
+    # колбэк выполнится только если транзакция будет успешно закоммичена
+    session.info.setdefault("after_commit", []).append(callback)
+
+
+def invalidate_on_change(session: AsyncSession, callback: typing.Callable[[], None]):
+    # сбрасываем кэш сразу и ещё раз после коммита: кэш, собранный до коммита, видел старые данные
+    callback()
+    after_commit(session, callback)
+
+
+@sa.event.listens_for(Session, "after_commit")
+def _run_after_commit(session: Session):
+    for callback in session.info.pop("after_commit", []):
+        callback()
+
+
+@sa.event.listens_for(Session, "after_rollback")
+def _drop_after_commit(session: Session):
+    session.info.pop("after_commit", None)
+
+
+# сколько коробок рассчитывается за один проход
+SETTLE_CHUNK_SIZE = 500
+# через сколько повторить попытку списать пошлину, если на счёте не хватило денег
+DUTY_RETRY_DELAY = dt.timedelta(minutes=5)
+# тайл карты - строка фиксированной длины
+TILE_SIZE = 768
+# сколько тайлов пишется или читается одним запросом
+MAP_WRITE_CHUNK = 1000
+
+
+def due_periods(last: dt.datetime, period: dt.timedelta, now: dt.datetime) -> int:
+    # число k >= 1, для которых last + k * period < now
+    if not period or now <= last:
+        return 0
+    n = (now - last) // period
+    if last + n * period >= now:
+        n -= 1
+    return n
+
+
 # Total per record: 296 byte
 class PlatfeUser(Base):
     __tablename__ = "platfe_users"
     id: Mapped[int] = mapped_column(primary_key=True)
     disid: Mapped[int] = mapped_column(sa.BigInteger)
-    name: Mapped[str] = mapped_column(sa.String(32, **create_string_param))
-    token: Mapped[str] = mapped_column(sa.String(200, **create_string_param))
+    name: Mapped[str] = mapped_column(sa.String(32, **create_string_param), index=True)
+    # устаревшее поле: токен в открытом виде остаётся только у пользователей, ещё не входивших после перехода на хэш
+    token: Mapped[typing.Optional[str]] = mapped_column(sa.String(200, **create_string_param), nullable=True)
+    token_hash: Mapped[typing.Optional[str]] = mapped_column(sa.String(64), nullable=True)
     disabled: Mapped[bool] = mapped_column(sa.Boolean, default=False)
 
+    @staticmethod
+    def hash_token(token: str) -> str:
+        # токен - 200 случайных символов, медленный хэш для него не нужен
+        return hashlib.sha256(token.encode()).hexdigest()
+
     @staticmethod
     async def create(session: AsyncSession, disid, name):
         token = pwd.genword(length=200, charset="ascii_62")
         await session.execute(
             sa.insert(PlatfeUser)
-            .values(disid=disid, name=name, token=token)
+            .values(disid=disid, name=name, token_hash=PlatfeUser.hash_token(token))
         )
+        invalidate_on_change(session, lambda: auth_cache.invalidate(name))
         return token
 
     async def reset_token(self, session: AsyncSession):
-        self.token = pwd.genword(length=200, charset="ascii_62")
+        token = pwd.genword(length=200, charset="ascii_62")
+        self.token_hash = PlatfeUser.hash_token(token)
         await session.execute(
             sa.update(PlatfeUser)
-            .values(token=self.token)
+            .values(token=None, token_hash=self.token_hash)
             .where(PlatfeUser.id == self.id)
         )
-        return self.token
+        self.invalidate_auth(session)
+        return token
+
+    async def disable(self, session: AsyncSession):
+        self.disabled = True
+        await session.execute(
+            sa.update(PlatfeUser)
+            .values(disabled=True)
+            .where(PlatfeUser.id == self.id)
+        )
+        self.invalidate_auth(session)
+
+    def invalidate_auth(self, session: AsyncSession):
+        user_id, name = self.id, self.name
+        invalidate_on_change(session, lambda: auth_cache.invalidate(name))
+        invalidate_on_change(session, lambda: principals.revoke(user_id))
 
     async def add_permission(self, session: AsyncSession, permission_string):
         await session.execute(
             sa.insert(PlatfePermissions)
             .values(user_id=self.id, permission_string=permission_string)
         )
+        self.invalidate_permissions(session)
 
     async def get_all_permission(self, session: AsyncSession):
         r = await session.execute(
@@ -65,26 +140,69 @@ class PlatfeUser(Base):
                 PlatfePermissions.user_id == self.id
             ))
         )
+        self.invalidate_permissions(session)
+
+    def invalidate_permissions(self, session: AsyncSession):
+        user_id = self.id
+        invalidate_on_change(session, lambda: permission_cache.invalidate(user_id))
+        invalidate_on_change(session, lambda: principals.invalidate(user_id))
+
+    async def get_permission_matcher(self, session: AsyncSession):
+        matcher = permission_cache.get(self.id)
+        if matcher is None:
+            generation = permission_cache.generation(self.id)
+            r = await session.execute(
+                sa.select(PlatfePermissions.permission_string)
+                .where(PlatfePermissions.user_id == self.id)
+            )
+            matcher = permission_cache.put(self.id, r.scalars().all(), generation)
+        return matcher
 
     async def has_permission(self, session: AsyncSession, permission_string):
-        r = await session.execute(
-            sa.select(PlatfePermissions.permission_string)
-            .where(PlatfePermissions.user_id == self.id)
-        )
-        perms = r.scalars().all()
-        return any([fn.fnmatch(permission_string, perm_str) for perm_str in perms])
+        return (await self.get_permission_matcher(session)).check(permission_string)
+
+    async def has_permissions(self, session: AsyncSession, permission_strings: typing.Iterable[str]):
+        return (await self.get_permission_matcher(session)).check_all(permission_strings)
 
     @staticmethod
     async def check_auth(session: AsyncSession, nickname, token):
+        digest = PlatfeUser.hash_token(token)
+        hit, usr = auth_cache.get(nickname, digest)
+        if hit:
+            return usr
+
+        generation = auth_cache.generation(nickname)
         r = await session.execute(
             sa.select(PlatfeUser)
             .where(sa.and_(
                 PlatfeUser.name == nickname,
-                PlatfeUser.token == token,
-                not PlatfeUser.disabled
+                PlatfeUser.disabled == sa.false()
             ))
         )
-        return r.scalar_one_or_none()
+        # имя не уникально: токен сверяется с каждой строкой с этим именем
+        usr = None
+        for candidate in r.scalars().all():
+            if candidate.token_hash is not None:
+                authed = hmac.compare_digest(candidate.token_hash, digest)
+            elif candidate.token is not None:
+                authed = hmac.compare_digest(candidate.token.encode(), token.encode())
+                if authed:
+                    # первый вход со старым токеном: заменяем его хэшем, сохранится при коммите сессии
+                    candidate.token_hash = digest
+                    candidate.token = None
+            else:
+                authed = False
+            if authed:
+                usr = candidate
+                break
+
+        if usr is None:
+            auth_cache.put(nickname, digest, None, generation)
+            return None
+        # в кэш кладём копию без привязки к сессии
+        user = PlatfeUser(id=usr.id, disid=usr.disid, name=usr.name, disabled=usr.disabled)
+        auth_cache.put(nickname, digest, user, generation)
+        return usr
 
     @staticmethod
     async def get_by_id(session: AsyncSession, user_id):
@@ -102,6 +220,27 @@ class PlatfeUser(Base):
         )
         return r.scalar_one_or_none()
 
+    @staticmethod
+    async def get_principal(session: AsyncSession, user_id, usr: "PlatfeUser" = None) -> typing.Optional[Principal]:
+        p = principals.get(user_id)
+        if p is not None:
+            return p
+
+        generation = principals.generation(user_id)
+        if usr is None:
+            usr = await PlatfeUser.get_by_id(session, user_id)
+            if usr is None:
+                return None
+
+        permissions = await usr.get_permission_matcher(session)
+        r = await session.execute(
+            sa.select(PlatfeAccountUserBridge.account_id)
+            .where(PlatfeAccountUserBridge.user_id == usr.id)
+        )
+        # копия строки без привязки к сессии: после коммита сессии её атрибуты не протухают
+        user = PlatfeUser(id=usr.id, disid=usr.disid, name=usr.name, disabled=usr.disabled)
+        return principals.put(Principal(user, permissions, frozenset(r.scalars().all())), generation)
+
 
 # Total per record: 264 byte
 class PlatfePermissions(Base):
@@ -126,6 +265,23 @@ class PlatfeWorlds(Base):
         )
         return r.scalar_one_or_none()
 
+    @staticmethod
+    async def get_world_ref(session: AsyncSession, world) -> typing.Optional[WorldRef]:
+        if not references.loaded:
+            await PlatfeCurrencies.load_references(session)
+        ref = references.world(world)
+        if ref is not None or references.is_missing_world(world):
+            return ref
+        if await PlatfeWorlds.get_world(session, world) is not None:
+            # мир добавили в базу в обход процесса
+            references.invalidate()
+            await PlatfeCurrencies.load_references(session)
+            ref = references.world(world)
+        else:
+            # имена несуществующих миров приходят и с публичных HTTP-маршрутов карты
+            references.miss_world(world)
+        return ref
+
 
 # Total per record: 44 byte
 class PlatfeCurrencies(Base):
@@ -151,6 +307,7 @@ class PlatfeCurrencies(Base):
             sa.insert(PlatfeCurrencies)
             .values(name=name, short_name=short_name)
         )
+        invalidate_on_change(session, references.invalidate)
 
         r = await session.execute(
             sa.select(PlatfeCurrencies)
@@ -175,6 +332,49 @@ class PlatfeCurrencies(Base):
         )
         return r.scalar_one_or_none()
 
+    @staticmethod
+    async def load_references(session: AsyncSession):
+        # валюты и миры загружаются вместе, двумя запросами на весь процесс
+        async with references.lock:
+            if references.loaded:
+                return
+            generation = references.generation
+            currencies = await session.execute(
+                sa.select(PlatfeCurrencies.id, PlatfeCurrencies.name, PlatfeCurrencies.short_name)
+            )
+            worlds = await session.execute(
+                sa.select(PlatfeWorlds.id, PlatfeWorlds.server_name, PlatfeWorlds.ip, PlatfeWorlds.world)
+            )
+            references.fill(
+                [CurrencyRef(*row) for row in currencies.all()],
+                [WorldRef(*row) for row in worlds.all()],
+                generation
+            )
+
+    @staticmethod
+    async def get_ref(session: AsyncSession, cur_id: int) -> typing.Optional[CurrencyRef]:
+        if not references.loaded:
+            await PlatfeCurrencies.load_references(session)
+        ref = references.currency(cur_id)
+        if ref is None and await PlatfeCurrencies.get_by_id(session, cur_id) is not None:
+            # валюту добавили в базу в обход процесса
+            references.invalidate()
+            await PlatfeCurrencies.load_references(session)
+            ref = references.currency(cur_id)
+        return ref
+
+    @staticmethod
+    async def get_ref_by_short_name(session: AsyncSession, short_name: str) -> typing.Optional[CurrencyRef]:
+        if not references.loaded:
+            await PlatfeCurrencies.load_references(session)
+        return references.currency_by_short_name(short_name)
+
+    @staticmethod
+    async def get_all_refs(session: AsyncSession) -> typing.List[CurrencyRef]:
+        if not references.loaded:
+            await PlatfeCurrencies.load_references(session)
+        return references.all_currencies()
+
     '''
     async def get_main_account(self, session: AsyncSession):
         if self.main_account_id == None:
@@ -193,7 +393,7 @@ class PlatfeAccountUserBridge(Base):
 class PlatfeMoneyTransferLog(Base):
     __tablename__ = "platfe_money_transfer_log"
     id: Mapped[int] = mapped_column(primary_key=True)
-    timestamp: Mapped[int] = mapped_column(sa.DateTime, default=dt.datetime.now())
+    timestamp: Mapped[int] = mapped_column(sa.DateTime, default=dt.datetime.now)
     doer_id: Mapped[int] = mapped_column(sa.ForeignKey("platfe_users.id"), nullable=True)
     doer_account_id: Mapped[int] = mapped_column(sa.ForeignKey("platfe_accounts.id"))
     destination_account_id: Mapped[int] = mapped_column(sa.ForeignKey("platfe_accounts.id"))
@@ -208,7 +408,7 @@ class PlatfeMoneyTransferLog(Base):
         r = await session.execute(
             sa.insert(PlatfeMoneyTransferLog)
             .values(
-                doer_id=doer.id,
+                doer_id=doer.id if doer is not None else None,
                 doer_account_id=doer_acc.id,
                 destination_account_id=des.id,
                 count=count
@@ -229,11 +429,7 @@ class PlatfeMoneyTransferLog(Base):
         return log_id != 0
 
     @staticmethod
-    async def rollback(session: AsyncSession, doer: PlatfeUser, time: dt.datetime = None, acc: "PlatfeAccounts" = None, usr: PlatfeUser = None):
-        # откаты других инстанций
-        await PlatfeBothSidedBoxLogs.rollback(session, doer, time, acc, usr)
-
-        # откаты самих переводов
+    def filter(time: dt.datetime = None, acc: "PlatfeAccounts" = None, usr: PlatfeUser = None):
         wr = []
         if time is not None:
             wr.append(PlatfeMoneyTransferLog.timestamp >= time)
@@ -243,36 +439,93 @@ class PlatfeMoneyTransferLog(Base):
 
         if usr is not None:
             wr.append(PlatfeMoneyTransferLog.doer_id == usr.id)
+        return wr
 
-        records = await session.execute(
-            sa.select(PlatfeMoneyTransferLog)
-            .where(sa.and_(*wr))
-        )
-        cors = []
-        for record in records.scalars().all():
-            cors.append(record.self_rollback(session, doer))
-        await asyncio.gather(*cors)
-
-    async def self_rollback(self, session: AsyncSession, doer: PlatfeUser):
-        acc1 = await PlatfeAccounts.get_force_by_id(session, self.doer_account_id)
-        acc2 = await PlatfeAccounts.get_force_by_id(session, self.destination_account_id)
-
-        if acc1 is None or acc2 is None:
-            return
+    @staticmethod
+    async def rollback(session: AsyncSession, doer: PlatfeUser, time: dt.datetime = None, acc: "PlatfeAccounts" = None, usr: PlatfeUser = None):
+        # откаты переводов вместе с операциями в коробках, которые на них ссылаются
+        return await PlatfeMoneyTransferLog.rollback_where(session, doer, PlatfeMoneyTransferLog.filter(time, acc, usr))
 
-        await acc2.transfer(session, doer, acc1, self.count)
+    @staticmethod
+    async def rollback_where(session: AsyncSession, doer: typing.Optional[PlatfeUser], wr: list) -> int:
+        # Откат всех ещё не откаченных переводов под условием wr фиксированным числом запросов,
+        # сколько бы переводов ни попало под условие: суммы по счетам считает база,
+        # обратные записи вставляются через INSERT ... SELECT, отметки и блокировки ставятся одним UPDATE.
+        wr = wr + [PlatfeMoneyTransferLog.is_rollback == sa.false()]
+        last_id = (await session.execute(
+            sa.select(sa.func.max(PlatfeMoneyTransferLog.id))
+            .where(sa.and_(*wr))
+        )).scalar()
+        if last_id is None:
+            return 0
+        # обратные записи получат id больше last_id и под откат не попадут
+        wr.append(PlatfeMoneyTransferLog.id <= last_id)
+        logs = sa.select(PlatfeMoneyTransferLog.id).where(sa.and_(*wr))
 
-        if acc2.balance < 0:
-            await acc2.block(session)
+        r = await session.execute(
+            sa.select(
+                PlatfeMoneyTransferLog.doer_account_id,
+                PlatfeMoneyTransferLog.destination_account_id,
+                sa.func.sum(PlatfeMoneyTransferLog.count),
+                sa.func.count()
+            )
+            .where(sa.and_(*wr))
+            .group_by(PlatfeMoneyTransferLog.doer_account_id, PlatfeMoneyTransferLog.destination_account_id)
+        )
+        deltas: typing.Dict[int, int] = {}
+        reverted = 0
+        for doer_account_id, destination_account_id, count, n in r.all():
+            deltas[doer_account_id] = deltas.get(doer_account_id, 0) + int(count)
+            deltas[destination_account_id] = deltas.get(destination_account_id, 0) - int(count)
+            reverted += n
 
+        await session.execute(
+            sa.insert(PlatfeMoneyTransferLog)
+            .from_select(
+                ["doer_id", "doer_account_id", "destination_account_id", "count"],
+                sa.select(
+                    sa.literal(doer.id if doer is not None else None, sa.Integer),
+                    PlatfeMoneyTransferLog.destination_account_id,
+                    PlatfeMoneyTransferLog.doer_account_id,
+                    PlatfeMoneyTransferLog.count
+                )
+                .where(sa.and_(*wr))
+                .order_by(PlatfeMoneyTransferLog.id)
+            )
+        )
+        await session.execute(
+            sa.update(PlatfeBothSidedBoxLogs)
+            .values(is_rollback=True)
+            .where(sa.and_(
+                PlatfeBothSidedBoxLogs.transfer_log_id.in_(logs),
+                PlatfeBothSidedBoxLogs.is_rollback == sa.false()
+            ))
+            .execution_options(synchronize_session=False)
+        )
         await session.execute(
             sa.update(PlatfeMoneyTransferLog)
             .values(is_rollback=True)
-            .where(PlatfeMoneyTransferLog.id == self.id)
+            .where(sa.and_(*wr))
+            .execution_options(synchronize_session=False)
+        )
+
+        await PlatfeAccounts.apply_deltas(session, deltas)
+        # счета, ушедшие в минус после отката, блокируются
+        await session.execute(
+            sa.update(PlatfeAccounts)
+            .values(blocked=1)
+            .where(sa.and_(
+                PlatfeAccounts.id.in_([acc_id for acc_id, delta in deltas.items() if delta < 0]),
+                PlatfeAccounts.balance < 0
+            ))
+            .execution_options(synchronize_session=False)
         )
+        return reverted
+
+    async def self_rollback(self, session: AsyncSession, doer: PlatfeUser):
+        await PlatfeMoneyTransferLog.rollback_where(session, doer, [PlatfeMoneyTransferLog.id == self.id])
 
 
-# Total per record: 52 byte
 class PlatfeAccounts(Base):
     __tablename__ = "platfe_accounts"
     id: Mapped[int] = mapped_column(primary_key=True)
@@ -288,7 +541,7 @@ class PlatfeAccounts(Base):
             sa.select(PlatfeAccounts).join(PlatfeAccountUserBridge)
             .where(sa.and_(
                 PlatfeAccountUserBridge.user_id == user.id,
-                not PlatfeAccounts.disabled
+                PlatfeAccounts.disabled == sa.false()
             ))
         )
         return r.scalars().all()
@@ -299,18 +552,29 @@ class PlatfeAccounts(Base):
             sa.select(PlatfeAccounts)
             .where(sa.and_(
                 PlatfeAccounts.name == acc_name,
-                not PlatfeAccounts.disabled
+                PlatfeAccounts.disabled == sa.false()
             ))
         )
         return r.scalar_one_or_none()
 
+    @staticmethod
+    async def get_by_names(session: AsyncSession, acc_names: typing.Iterable[str]):
+        r = await session.execute(
+            sa.select(PlatfeAccounts)
+            .where(sa.and_(
+                PlatfeAccounts.name.in_(set(acc_names)),
+                PlatfeAccounts.disabled == sa.false()
+            ))
+        )
+        return {acc.name: acc for acc in r.scalars().all()}
+
     @staticmethod
     async def get_by_id(session: AsyncSession, payer_id):
         r = await session.execute(
             sa.select(PlatfeAccounts)
             .where(sa.and_(
                 PlatfeAccounts.id == payer_id,
-                not PlatfeAccounts.disabled
+                PlatfeAccounts.disabled == sa.false()
             ))
         )
         return r.scalar_one_or_none()
@@ -364,6 +628,10 @@ class PlatfeAccounts(Base):
             await session.rollback()
             return None
 
+        user_id = user.id
+        invalidate_on_change(session, lambda: principals.invalidate(user_id))
+        after_commit(session, lambda: registry_accounts.bump("status"))
+
         return acc
 
     @staticmethod
@@ -373,15 +641,92 @@ class PlatfeAccounts(Base):
         )
         return r.scalars().all()
 
+    @staticmethod
+    async def get_registry(session: AsyncSession) -> typing.Dict[str, str]:
+        # "<счёт>$<валюта>" -> "<владелец>$<владелец>..." одним запросом; владельцы собираются здесь, а не GROUP_CONCAT:
+        # у того нет гарантированного порядка (лишние дельты реестра) и он обрезается по group_concat_max_len
+        r = await session.execute(
+            sa.select(PlatfeAccounts.name, PlatfeCurrencies.short_name, PlatfeUser.name)
+            .join(PlatfeCurrencies, PlatfeCurrencies.id == PlatfeAccounts.currency_id)
+            .outerjoin(PlatfeAccountUserBridge, PlatfeAccountUserBridge.account_id == PlatfeAccounts.id)
+            .outerjoin(PlatfeUser, PlatfeUser.id == PlatfeAccountUserBridge.user_id)
+            .where(PlatfeAccounts.disabled == sa.false())
+            .order_by(PlatfeAccounts.id, PlatfeUser.id)
+        )
+        owners: typing.Dict[str, typing.List[str]] = {}
+        for name, short_name, user_name in r.tuples().all():
+            names = owners.setdefault(name + '$' + short_name, [])
+            if user_name is not None:
+                names.append(user_name)
+        return {key: '$'.join(names) for key, names in owners.items()}
+
     async def get_owners(self, session: AsyncSession):
+        return await PlatfeAccounts.get_owners_of(session, [self.id])
+
+    @staticmethod
+    async def get_owners_of(session: AsyncSession, acc_ids: typing.Iterable[int]):
+        # владельцы сразу нескольких счетов одним запросом, каждый пользователь один раз
         r = await session.execute(
-            sa.select(PlatfeUser).join(PlatfeAccountUserBridge)
-            .where(
-                PlatfeAccountUserBridge.account_id == self.id
-            )
+            sa.select(PlatfeUser)
+            .where(PlatfeUser.id.in_(
+                sa.select(PlatfeAccountUserBridge.user_id)
+                .where(PlatfeAccountUserBridge.account_id.in_(set(acc_ids)))
+            ))
         )
         return r.scalars().all()
 
+    @staticmethod
+    async def get_owners_map(session: AsyncSession, acc_ids: typing.Iterable[int]):
+        # {id счёта: [владельцы]} для нескольких счетов одним запросом
+        r = await session.execute(
+            sa.select(PlatfeAccountUserBridge.account_id, PlatfeUser)
+            .join(PlatfeUser, PlatfeUser.id == PlatfeAccountUserBridge.user_id)
+            .where(PlatfeAccountUserBridge.account_id.in_(set(acc_ids)))
+        )
+        owners: typing.Dict[int, typing.List[PlatfeUser]] = {}
+        for acc_id, usr in r.all():
+            owners.setdefault(acc_id, []).append(usr)
+        return owners
+
+    @staticmethod
+    async def lock(session: AsyncSession, acc_ids: typing.Iterable[int], usr: typing.Optional[PlatfeUser] = None):
+        # Блокирует строки счетов до конца транзакции и перечитывает их актуальное состояние.
+        # Строки всегда берутся в порядке id, поэтому встречные переводы не блокируют друг друга крест-накрест.
+        # Вместе со счётом возвращается, является ли usr его владельцем.
+        if usr is None:
+            owned = sa.false()
+        else:
+            owned = sa.exists().where(sa.and_(
+                PlatfeAccountUserBridge.account_id == PlatfeAccounts.id,
+                PlatfeAccountUserBridge.user_id == usr.id
+            ))
+        r = await session.execute(
+            sa.select(PlatfeAccounts, owned.label("owned"))
+            .where(PlatfeAccounts.id.in_(set(acc_ids)))
+            .order_by(PlatfeAccounts.id)
+            .with_for_update(of=PlatfeAccounts)
+            .execution_options(populate_existing=True)
+        )
+        return {acc.id: (acc, bool(is_owner)) for acc, is_owner in r.all()}
+
+    @staticmethod
+    async def apply_deltas(session: AsyncSession, deltas: typing.Dict[int, int]):
+        # все изменения балансов одним UPDATE ... CASE id
+        deltas = {acc_id: delta for acc_id, delta in deltas.items() if delta != 0}
+        if not deltas:
+            return
+        await session.execute(
+            sa.update(PlatfeAccounts)
+            .values(balance=PlatfeAccounts.balance + sa.case(deltas, value=PlatfeAccounts.id, else_=0))
+            .where(PlatfeAccounts.id.in_(deltas.keys()))
+            .execution_options(synchronize_session=False)
+        )
+        # загруженные в сессию счета обновляем без пометки об изменении, иначе коммит перезапишет баланс
+        for acc_id, delta in deltas.items():
+            acc = session.sync_session.identity_map.get(Session.identity_key(PlatfeAccounts, acc_id))
+            if acc is not None and "balance" in acc.__dict__:
+                set_committed_value(acc, "balance", acc.balance + delta)
+
     async def transfer(self, session: AsyncSession, usr: typing.Optional[PlatfeUser], acc: "PlatfeAccounts",
                        count: int) -> int:
         if count <= 0:
@@ -390,17 +735,7 @@ class PlatfeAccounts(Base):
         if self.currency_id != acc.currency_id:
             return -3
 
-        await session.execute(
-            sa.update(PlatfeAccounts)
-            .values(balance=PlatfeAccounts.balance - count)
-            .where(PlatfeAccounts.id == self.id)
-        )
-
-        await session.execute(
-            sa.update(PlatfeAccounts)
-            .values(balance=PlatfeAccounts.balance + count)
-            .where(PlatfeAccounts.id == acc.id)
-        )
+        await PlatfeAccounts.apply_deltas(session, {self.id: -count, acc.id: count})
         log_id = await PlatfeMoneyTransferLog.create(session, usr, self, acc, count)
         if PlatfeMoneyTransferLog.check_create(log_id):
             return log_id
@@ -411,25 +746,112 @@ class PlatfeAccounts(Base):
         return await self.transfer(session, None, acc, count)
 
     async def pay(self, session: AsyncSession, usr: PlatfeUser, acc: "PlatfeAccounts", count: int) -> int:
+        # три запроса: блокировка обоих счетов с проверкой владельца, UPDATE балансов и запись в лог
         if count <= 0:
             return -1
 
-        if self.blocked:
-            return -4
-
         if self.id == acc.id:
             return -7
 
-        if self.currency_id != acc.currency_id:
+        locked = await PlatfeAccounts.lock(session, [self.id, acc.id], usr)
+        if self.id not in locked or acc.id not in locked:
+            return -5
+        src, is_owner = locked[self.id]
+        des, _ = locked[acc.id]
+
+        if src.disabled or des.disabled:
+            return -5
+
+        if src.blocked:
+            return -4
+
+        if src.currency_id != des.currency_id:
             return -3
 
-        if self.balance - count < 0:
+        if src.balance - count < 0:
             return -2
 
-        if not (usr in (await self.get_owners(session))):
+        if not is_owner:
             return -6
 
-        return await self.transfer(session, usr, acc, count)
+        return await src.transfer(session, usr, des, count)
+
+    @staticmethod
+    async def pay_batch(session: AsyncSession, usr: PlatfeUser,
+                        items: typing.List[typing.Tuple[typing.Optional["PlatfeAccounts"], typing.Optional["PlatfeAccounts"], int]]) -> typing.List[int]:
+        return await PlatfeAccounts.transfer_batch(session, [
+            (usr, acc1.id if acc1 is not None else None, acc2.id if acc2 is not None else None, count)
+            for acc1, acc2, count in items
+        ])
+
+    @staticmethod
+    async def transfer_batch(session: AsyncSession,
+                             items: typing.List[typing.Tuple[PlatfeUser, typing.Optional[int], typing.Optional[int], int]]) -> typing.List[int]:
+        # Пачка переводов (пользователь, id счёта-источника, id счёта-получателя, сумма) в одной транзакции:
+        # все счета блокируются и перечитываются одним запросом, переводы проверяются по порядку на текущих балансах,
+        # затем один UPDATE и одна вставка в лог. Для каждого перевода возвращается код из PAY_STATUS.
+        acc_ids = {acc_id for item in items for acc_id in item[1:3] if acc_id is not None}
+        user_ids = {usr.id for usr, *_ in items}
+        if not acc_ids:
+            locked, owned = {}, set()
+        elif len(user_ids) == 1:
+            # все переводы от одного пользователя: владение проверяется тем же запросом, что и блокировка
+            locked = await PlatfeAccounts.lock(session, acc_ids, items[0][0])
+            owned = {(acc_id, items[0][0].id) for acc_id, (_, is_owner) in locked.items() if is_owner}
+        else:
+            locked = await PlatfeAccounts.lock(session, acc_ids)
+            r = await session.execute(
+                sa.select(PlatfeAccountUserBridge.account_id, PlatfeAccountUserBridge.user_id)
+                .where(sa.and_(
+                    PlatfeAccountUserBridge.account_id.in_(acc_ids),
+                    PlatfeAccountUserBridge.user_id.in_(user_ids)
+                ))
+            )
+            owned = set(r.tuples().all())
+        balances = {acc_id: acc.balance for acc_id, (acc, _) in locked.items()}
+
+        statuses = []
+        deltas: typing.Dict[int, int] = {}
+        logs = []
+        for usr, acc1_id, acc2_id, count in items:
+            if acc1_id not in locked or acc2_id not in locked:
+                statuses.append(-5)
+                continue
+            src, _ = locked[acc1_id]
+            des, _ = locked[acc2_id]
+
+            if count <= 0:
+                status = -1
+            elif src.id == des.id:
+                status = -7
+            elif src.disabled or des.disabled:
+                status = -5
+            elif src.blocked:
+                status = -4
+            elif src.currency_id != des.currency_id:
+                status = -3
+            elif balances[src.id] - count < 0:
+                status = -2
+            elif (src.id, usr.id) not in owned:
+                status = -6
+            else:
+                status = 0
+                balances[src.id] -= count
+                balances[des.id] += count
+                deltas[src.id] = deltas.get(src.id, 0) - count
+                deltas[des.id] = deltas.get(des.id, 0) + count
+                logs.append({
+                    "doer_id": usr.id,
+                    "doer_account_id": src.id,
+                    "destination_account_id": des.id,
+                    "count": count
+                })
+            statuses.append(status)
+
+        if logs:
+            await PlatfeAccounts.apply_deltas(session, deltas)
+            await session.execute(sa.insert(PlatfeMoneyTransferLog), logs)
+        return statuses
 
     async def block(self, session: AsyncSession):
         await session.execute(
@@ -444,24 +866,171 @@ class PlatfeAccounts(Base):
             .values(disabled=True)
             .where(PlatfeAccounts.id == self.id)
         )
+        after_commit(session, lambda: registry_accounts.bump("status"))
 
 
 # Total per record: 812 byte
 class PlatfeMap(Base):
     __tablename__ = "platfe_map"
+    __table_args__ = (
+        sa.UniqueConstraint("world", "chunk_x", "chunk_y", name="uq_platfe_map_world_chunk"),
+    )
     id: Mapped[int] = mapped_column(primary_key=True)
     world: Mapped[int] = mapped_column(sa.ForeignKey("platfe_worlds.id"))
     chunk_x: Mapped[int] = mapped_column(sa.Integer)
     chunk_y: Mapped[int] = mapped_column(sa.Integer)
     tile_hash: Mapped[str] = mapped_column(sa.String(32, **create_string_param))
-    tile: Mapped[str] = mapped_column(sa.String(768, **create_string_param))
+    tile: Mapped[str] = mapped_column(sa.String(TILE_SIZE, **create_string_param))
+
+    @staticmethod
+    def hash_tile(tile: str) -> str:
+        return hashlib.md5(tile.encode("ascii")).hexdigest()
+
+    @staticmethod
+    async def get_hashes(session: AsyncSession, world_id: int, keys: typing.Iterable[typing.Tuple[int, int]]):
+        # {(chunk_x, chunk_y): (id, tile_hash)} для уже сохранённых тайлов, по индексу (world, chunk_x, chunk_y)
+        keys = list(keys)
+        r = {}
+        for i in range(0, len(keys), MAP_WRITE_CHUNK):
+            rows = await session.execute(
+                sa.select(PlatfeMap.chunk_x, PlatfeMap.chunk_y, PlatfeMap.id, PlatfeMap.tile_hash)
+                .where(sa.and_(
+                    PlatfeMap.world == world_id,
+                    sa.tuple_(PlatfeMap.chunk_x, PlatfeMap.chunk_y).in_(keys[i:i + MAP_WRITE_CHUNK])
+                ))
+            )
+            for chunk_x, chunk_y, tile_id, tile_hash in rows.all():
+                r[(chunk_x, chunk_y)] = (tile_id, tile_hash)
+        return r
+
+    @staticmethod
+    async def upload(session: AsyncSession, usr: PlatfeUser, world_id: int,
+                     tiles: typing.Dict[typing.Tuple[int, int], str]) -> int:
+        # Пачка тайлов одного мира. Неизменившиеся тайлы отсеиваются по хэшу: сначала по tile_hashes,
+        # затем одним чтением хэшей из базы. Изменившиеся и новые пишутся пачками INSERT ... ON DUPLICATE KEY UPDATE
+        # по (world, chunk_x, chunk_y). Подтверждение от usr записывается для каждого тайла пачки одной вставкой.
+        # Возвращает, сколько тайлов было записано.
+        hashes = {key: PlatfeMap.hash_tile(tile) for key, tile in tiles.items()}
+        ids: typing.Dict[typing.Tuple[int, int], int] = {}
+        unknown = []
+        for key, tile_hash in hashes.items():
+            cached = tile_hashes.get((world_id,) + key)
+            if cached is not None and cached[1] == tile_hash:
+                ids[key] = cached[0]
+            else:
+                unknown.append(key)
+
+        existing = await PlatfeMap.get_hashes(session, world_id, unknown)
+        rows = []
+        for key in unknown:
+            if key in existing:
+                ids[key] = existing[key][0]
+                if existing[key][1] == hashes[key]:
+                    continue
+            rows.append({
+                "world": world_id,
+                "chunk_x": key[0],
+                "chunk_y": key[1],
+                "tile_hash": hashes[key],
+                "tile": tiles[key]
+            })
+
+        for i in range(0, len(rows), MAP_WRITE_CHUNK):
+            insert = mysql_insert(PlatfeMap).values(rows[i:i + MAP_WRITE_CHUNK])
+            await session.execute(
+                insert.on_duplicate_key_update(tile_hash=insert.inserted.tile_hash, tile=insert.inserted.tile)
+            )
+        # id при обновлении не меняется, дочитываются только id новых строк
+        created = await PlatfeMap.get_hashes(session, world_id, [key for key in hashes if key not in ids])
+        for key, (tile_id, _) in created.items():
+            ids[key] = tile_id
+
+        now = dt.datetime.now()
+        if ids:
+            await session.execute(sa.insert(PlatfeMapConfirmations), [
+                {"timestamp": now, "transaction_id": tile_id, "user_id": usr.id} for tile_id in ids.values()
+            ])
+
+        def update_cache():
+            for key, tile_id in ids.items():
+                tile_hashes.put((world_id,) + key, tile_id, hashes[key])
+            for row in rows:
+                tile_cache.refresh((world_id, row["chunk_x"], row["chunk_y"]), (row["tile_hash"], row["tile"]))
+        after_commit(session, update_cache)
+        return len(rows)
+
+    @staticmethod
+    async def get_tiles(session: AsyncSession, world_id: int, keys: typing.Iterable[typing.Tuple[int, int]]):
+        # {(chunk_x, chunk_y): (tile_hash, tile)}; отсутствующих тайлов в ответе нет
+        keys = list(keys)
+        r = {}
+        for i in range(0, len(keys), MAP_WRITE_CHUNK):
+            rows = await session.execute(
+                sa.select(PlatfeMap.chunk_x, PlatfeMap.chunk_y, PlatfeMap.tile_hash, PlatfeMap.tile)
+                .where(sa.and_(
+                    PlatfeMap.world == world_id,
+                    sa.tuple_(PlatfeMap.chunk_x, PlatfeMap.chunk_y).in_(keys[i:i + MAP_WRITE_CHUNK])
+                ))
+            )
+            for chunk_x, chunk_y, tile_hash, tile in rows.all():
+                r[(chunk_x, chunk_y)] = (tile_hash, tile)
+        return r
+
+    @staticmethod
+    async def get_cached_tiles(session: AsyncSession, world_id: int, keys: typing.Iterable[typing.Tuple[int, int]],
+                               expected: typing.Optional[typing.Dict[typing.Tuple[int, int], str]] = None):
+        # Тайлы через tile_cache, промахи дочитываются из базы одним проходом.
+        # expected - хэши, с которыми тайлы уже отданы клиенту (ETag пачки): запись кэша с другим хэшем не берётся.
+        # Кэш заполняется, только если чтение начинает новую транзакцию: снимок уже открытой транзакции
+        # мог быть сделан до загрузки тайла, которую begin / fill не увидят.
+        r: typing.Dict[typing.Tuple[int, int], typing.Optional[typing.Tuple[str, str]]] = {}
+        missed = []
+        for key in keys:
+            hit, entry = tile_cache.get((world_id,) + key)
+            if hit and (expected is None or (entry is not None and entry[0] == expected.get(key))):
+                r[key] = entry
+            else:
+                missed.append(key)
+        if not missed:
+            return r
+
+        if session.in_transaction():
+            found = await PlatfeMap.get_tiles(session, world_id, missed)
+            for key in missed:
+                r[key] = found.get(key)
+            return r
+
+        cache_keys = [(world_id,) + key for key in missed]
+        generation = tile_cache.begin(cache_keys)
+        try:
+            found = await PlatfeMap.get_tiles(session, world_id, missed)
+            tile_cache.fill({(world_id,) + key: found.get(key) for key in missed}, generation)
+        finally:
+            tile_cache.end(cache_keys)
+        for key in missed:
+            r[key] = found.get(key)
+        return r
+
+    @staticmethod
+    async def get_hashes_in_range(session: AsyncSession, world_id: int, x1: int, y1: int, x2: int, y2: int):
+        # [(chunk_x, chunk_y, tile_hash)] существующих тайлов прямоугольника, по индексу (world, chunk_x, chunk_y)
+        r = await session.execute(
+            sa.select(PlatfeMap.chunk_x, PlatfeMap.chunk_y, PlatfeMap.tile_hash)
+            .where(sa.and_(
+                PlatfeMap.world == world_id,
+                PlatfeMap.chunk_x.between(x1, x2),
+                PlatfeMap.chunk_y.between(y1, y2)
+            ))
+            .order_by(PlatfeMap.chunk_x, PlatfeMap.chunk_y)
+        )
+        return r.tuples().all()
 
 
 # Total per record: 20 byte
 class PlatfeMapConfirmations(Base):
     __tablename__ = "platfe_map_confirmations"
     id: Mapped[int] = mapped_column(primary_key=True)
-    timestamp: Mapped[dt.datetime] = mapped_column(sa.DateTime, default=dt.datetime.now())
+    timestamp: Mapped[dt.datetime] = mapped_column(sa.DateTime, default=dt.datetime.now)
     transaction_id: Mapped[int] = mapped_column(sa.ForeignKey("platfe_map.id"))
     user_id: Mapped[int] = mapped_column(sa.ForeignKey("platfe_users.id"))
 
@@ -558,12 +1127,16 @@ class PlatfeNicknameStatus(Base):
             sa.delete(PlatfeNicknameStatus)
             .where(PlatfeNicknameStatus.id == self.id)
         )
+        status_id = self.id
+        after_commit(session, lambda: status_snapshot.delete(status_id))
 
     async def add_prefix(self, session: AsyncSession, prf: PlatfePrefix):
         await session.execute(
             sa.insert(PlatfePrefixStatusBridge)
             .values(prefix_id=prf.id, status_id=self.id)
         )
+        status_id, nickname, prefix_id, prefix_string = self.id, self.nickname, prf.id, prf.serialize_string()
+        after_commit(session, lambda: status_snapshot.add_prefix(status_id, nickname, prefix_id, prefix_string))
 
     async def del_prefix(self, session: AsyncSession, prf: PlatfePrefix):
         await session.execute(
@@ -573,6 +1146,8 @@ class PlatfeNicknameStatus(Base):
                 PlatfePrefixStatusBridge.prefix_id == prf.id
             ))
         )
+        status_id, prefix_id = self.id, prf.id
+        after_commit(session, lambda: status_snapshot.del_prefix(status_id, prefix_id))
 
     @staticmethod
     async def get_all_statuses(session: AsyncSession):
@@ -596,12 +1171,37 @@ class PlatfeNicknameStatus(Base):
         )
         return r.scalars().all()
 
+    @staticmethod
+    async def load_snapshot(session: AsyncSession):
+        async with status_snapshot.lock:
+            if status_snapshot.loaded:
+                return
+            generation = status_snapshot.generation
+            r = await session.execute(
+                sa.select(PlatfeNicknameStatus.id, PlatfeNicknameStatus.nickname, PlatfePrefix)
+                .join(PlatfePrefixStatusBridge, PlatfePrefixStatusBridge.status_id == PlatfeNicknameStatus.id)
+                .join(PlatfePrefix, PlatfePrefix.id == PlatfePrefixStatusBridge.prefix_id)
+                .order_by(PlatfePrefixStatusBridge.id)
+            )
+            status_snapshot.fill(
+                [(status_id, nickname, prf.id, prf.serialize_string()) for status_id, nickname, prf in r.all()],
+                generation
+            )
+
+    @staticmethod
+    async def get_registry(session: AsyncSession):
+        if not status_snapshot.loaded:
+            await PlatfeNicknameStatus.load_snapshot(session)
+        return status_snapshot.registry()
+
 
 class PlatfeDuty(Base):
     __tablename__ = "platfe_duty"
     id: Mapped[int] = mapped_column(primary_key=True)
-    created_timestamp: Mapped[dt.datetime] = mapped_column(sa.DateTime, default=dt.datetime.now())
-    last_duty_timestamp: Mapped[dt.datetime] = mapped_column(sa.DateTime, default=dt.datetime.now())
+    created_timestamp: Mapped[dt.datetime] = mapped_column(sa.DateTime, default=dt.datetime.now)
+    last_duty_timestamp: Mapped[dt.datetime] = mapped_column(sa.DateTime, default=dt.datetime.now)
+    # когда пошлину нужно проверить в следующий раз; NULL - пока нет плательщика
+    next_due_timestamp: Mapped[typing.Optional[dt.datetime]] = mapped_column(sa.DateTime, nullable=True, index=True)
     payer_account_id: Mapped[int] = mapped_column(sa.ForeignKey("platfe_accounts.id"), default=None, nullable=True)
     owner_account_id: Mapped[int] = mapped_column(sa.ForeignKey("platfe_accounts.id"))
     period: Mapped[dt.timedelta] = mapped_column(sa.Interval)
@@ -612,6 +1212,7 @@ class PlatfeDuty(Base):
         r = await session.execute(
             sa.insert(PlatfeDuty)
             .values(
+                last_duty_timestamp=dt.datetime.now(),
                 owner_account_id=owner_account.id,
                 period=period,
                 tax_amount=tax_amount
@@ -634,13 +1235,39 @@ class PlatfeDuty(Base):
         )
         return r.scalars().all()
 
+    @staticmethod
+    async def get_due_ids(session: AsyncSession, until: dt.datetime):
+        r = await session.execute(
+            sa.select(PlatfeDuty.id, PlatfeDuty.next_due_timestamp)
+            .where(PlatfeDuty.next_due_timestamp <= until)
+        )
+        return r.tuples().all()
+
+    @staticmethod
+    async def get_unscheduled_chunk(session: AsyncSession, after_id: int, limit: int = SETTLE_CHUNK_SIZE):
+        # пошлины с плательщиком, назначенным до появления next_due_timestamp
+        r = await session.execute(
+            sa.select(PlatfeDuty)
+            .where(sa.and_(
+                PlatfeDuty.id > after_id,
+                PlatfeDuty.next_due_timestamp.is_(None),
+                PlatfeDuty.payer_account_id.is_not(None)
+            ))
+            .order_by(PlatfeDuty.id)
+            .limit(limit)
+        )
+        return r.scalars().all()
+
     async def set_payer(self, session: AsyncSession, payer_account: PlatfeAccounts):
+        next_due = self.last_duty_timestamp + self.period
         r = await session.execute(
             sa.update(PlatfeDuty)
-            .values(payer_account_id=payer_account.id)
+            .values(payer_account_id=payer_account.id, next_due_timestamp=next_due)
             .where(PlatfeDuty.id == self.id)
         )
-        return r.rowcount() != 0
+        duty_id = self.id
+        after_commit(session, lambda: due_queue.schedule("duty", duty_id, next_due))
+        return r.rowcount != 0
 
     async def check(self, session: AsyncSession) -> bool:
         r = await session.execute(
@@ -648,26 +1275,80 @@ class PlatfeDuty(Base):
             .where(PlatfeDuty.id == self.id)
         )
         r = r.scalar_one_or_none()
-        if not r or not r.payer_account_id:
+        if not r:
             return True
+        return (await PlatfeDuty.settle(session, [r]))[r.id][0]
 
-        if not r.owner_account_id:
-            return False
-
-        payer_acc = await PlatfeAccounts.get_by_id(session, r.payer_account_id)
-        owner_acc = await PlatfeAccounts.get_by_id(session, r.owner_account_id)
-
-        if payer_acc is None or owner_acc is None:
-            return False
-
-        while payer_acc.balance - r.tax_amount >= 0 and r.last_duty_timestamp + r.period < dt.datetime.now():
-            r.last_duty_timestamp += r.period
-            await payer_acc.system_transfer(session, owner_acc, r.tax_amount)
-
-        if payer_acc.balance - r.tax_amount < 0 and r.last_duty_timestamp + r.period < dt.datetime.now():
-            return False
-        else:
-            return True
+    @staticmethod
+    async def settle(session: AsyncSession, duties: typing.List["PlatfeDuty"], now: dt.datetime = None):
+        # Все прошедшие периоды оплачиваются одним переводом на пошлину, как аренда коробок.
+        # Возвращает {id: (всё ли оплачено, когда проверить в следующий раз)}.
+        if now is None:
+            now = dt.datetime.now()
+        locked = await PlatfeAccounts.lock(
+            session,
+            {d.payer_account_id for d in duties if d.payer_account_id} |
+            {d.owner_account_id for d in duties if d.owner_account_id}
+        )
+        balances = {acc_id: acc.balance for acc_id, (acc, _) in locked.items() if not acc.disabled}
+
+        r: typing.Dict[int, typing.Tuple[bool, typing.Optional[dt.datetime]]] = {}
+        deltas: typing.Dict[int, int] = {}
+        logs = []
+        timestamps: typing.Dict[int, dt.datetime] = {}
+        for d in duties:
+            if not d.payer_account_id:
+                r[d.id] = (True, None)
+                continue
+            if d.payer_account_id not in balances or d.owner_account_id not in balances:
+                r[d.id] = (False, now + DUTY_RETRY_DELAY)
+                continue
+
+            due = due_periods(d.last_duty_timestamp, d.period, now)
+            if d.tax_amount > 0:
+                paid = min(due, max(balances[d.payer_account_id], 0) // d.tax_amount)
+            else:
+                paid = due
+            last = d.last_duty_timestamp + paid * d.period
+            if paid > 0:
+                timestamps[d.id] = last
+                charge = paid * d.tax_amount
+                if charge > 0:
+                    balances[d.payer_account_id] -= charge
+                    balances[d.owner_account_id] += charge
+                    deltas[d.payer_account_id] = deltas.get(d.payer_account_id, 0) - charge
+                    deltas[d.owner_account_id] = deltas.get(d.owner_account_id, 0) + charge
+                    logs.append({
+                        "doer_id": None,
+                        "doer_account_id": d.payer_account_id,
+                        "destination_account_id": d.owner_account_id,
+                        "count": charge
+                    })
+            if paid < due:
+                # долг остаётся, last_duty_timestamp не двигается дальше оплаченного
+                r[d.id] = (False, now + DUTY_RETRY_DELAY)
+            else:
+                r[d.id] = (True, last + d.period)
+
+        await PlatfeAccounts.apply_deltas(session, deltas)
+        if logs:
+            await session.execute(sa.insert(PlatfeMoneyTransferLog), logs)
+        if timestamps:
+            await session.execute(
+                sa.update(PlatfeDuty)
+                .values(last_duty_timestamp=sa.case(timestamps, value=PlatfeDuty.id))
+                .where(PlatfeDuty.id.in_(timestamps.keys()))
+                .execution_options(synchronize_session=False)
+            )
+        next_due = {d.id: r[d.id][1] for d in duties if r[d.id][1] != d.next_due_timestamp}
+        if next_due:
+            await session.execute(
+                sa.update(PlatfeDuty)
+                .values(next_due_timestamp=sa.case(next_due, value=PlatfeDuty.id))
+                .where(PlatfeDuty.id.in_(next_due.keys()))
+                .execution_options(synchronize_session=False)
+            )
+        return r
 
 
 class PlatfeBothSidedBoxLogs(Base):
@@ -688,44 +1369,32 @@ class PlatfeBothSidedBoxLogs(Base):
 
     @staticmethod
     async def rollback(session: AsyncSession, doer: PlatfeUser, time: dt.datetime = None, acc: PlatfeAccounts = None, usr: PlatfeUser = None):
-        wr = []
-        if time is not None:
-            wr.append(PlatfeMoneyTransferLog.timestamp >= time)
-
-        if acc is not None:
-            wr.append(PlatfeMoneyTransferLog.doer_account_id == acc.id)
-
-        if usr is not None:
-            wr.append(PlatfeMoneyTransferLog.doer_id == usr.id)
-
-        records = await session.execute(
-            sa.select(PlatfeBothSidedBoxLogs).join(PlatfeMoneyTransferLog)
-            .where(sa.and_(*wr))
-        )
-        cors = []
-        for record in records.scalars().all():
-            t = await PlatfeMoneyTransferLog.get_by_id(session, record.transfer_log_id)
-            cors.append(t.self_rollback(session, doer))
-            await record.set_rollback(session)
-
-        await asyncio.gather(*cors)
+        # откатываются только переводы, по которым были операции в коробках
+        wr = PlatfeMoneyTransferLog.filter(time, acc, usr)
+        wr.append(PlatfeMoneyTransferLog.id.in_(sa.select(PlatfeBothSidedBoxLogs.transfer_log_id)))
+        return await PlatfeMoneyTransferLog.rollback_where(session, doer, wr)
 
 
 class PlatfeBothSidedBox(Base):
     __tablename__ = "platfe_both_sided_box"
+    __table_args__ = (
+        sa.Index("ix_platfe_both_sided_box_world_xyz", "world_id", "x", "y", "z"),
+    )
     id: Mapped[int] = mapped_column(primary_key=True)
-    created_timestamp: Mapped[dt.datetime] = mapped_column(sa.DateTime, default=dt.datetime.now())
+    created_timestamp: Mapped[dt.datetime] = mapped_column(sa.DateTime, default=dt.datetime.now)
     x: Mapped[int] = mapped_column(sa.Integer)
     y: Mapped[int] = mapped_column(sa.Integer)
     z: Mapped[int] = mapped_column(sa.Integer)
     world_id: Mapped[int] = mapped_column(sa.ForeignKey("platfe_worlds.id"))
 
     # cyclic duty block
-    last_duty_timestamp: Mapped[dt.datetime] = mapped_column(sa.DateTime, default=dt.datetime.now())
+    last_duty_timestamp: Mapped[dt.datetime] = mapped_column(sa.DateTime, default=dt.datetime.now)
+    # когда наступает следующий период аренды; NULL - аренды нет
+    next_due_timestamp: Mapped[typing.Optional[dt.datetime]] = mapped_column(sa.DateTime, nullable=True, index=True)
     payer_acc_id: Mapped[int] = mapped_column(sa.ForeignKey("platfe_accounts.id"))
     main_acc_id: Mapped[int] = mapped_column(sa.ForeignKey("platfe_accounts.id"))
-    period: Mapped[int] = mapped_column(sa.Interval)
-    tax_amount: Mapped[int] = mapped_column(sa.Integer)
+    period: Mapped[typing.Optional[dt.timedelta]] = mapped_column(sa.Interval, nullable=True)
+    tax_amount: Mapped[int] = mapped_column(sa.Integer, default=0)
 
     mc_item_id: Mapped[str] = mapped_column(sa.String(256, **create_string_param))
     mc_item_tag: Mapped[str] = mapped_column(sa.String(2048, **create_string_param))
@@ -746,14 +1415,82 @@ class PlatfeBothSidedBox(Base):
                 PlatfeBothSidedBox.y == y,
                 PlatfeBothSidedBox.z == z,
                 PlatfeBothSidedBox.world_id == world.id,
-                not PlatfeBothSidedBox.disabled
+                PlatfeBothSidedBox.disabled == sa.false()
             ))
         )
         return r.scalar_one_or_none()
 
+    @staticmethod
+    async def lock_coordinates(session: AsyncSession, x, y, z, world) -> bool:
+        # SELECT ... FOR UPDATE по ix_platfe_both_sided_box_world_xyz: блокирует и занятую строку, и пустой промежуток,
+        # поэтому из двух одновременных регистраций в одной точке закоммитится только одна
+        r = await session.execute(
+            sa.select(PlatfeBothSidedBox.id)
+            .where(sa.and_(
+                PlatfeBothSidedBox.world_id == world.id,
+                PlatfeBothSidedBox.x == x,
+                PlatfeBothSidedBox.y == y,
+                PlatfeBothSidedBox.z == z,
+                PlatfeBothSidedBox.disabled == sa.false()
+            ))
+            .with_for_update()
+        )
+        return r.first() is not None
+
     @staticmethod
     async def check_xyz(session: AsyncSession, x, y, z, world: PlatfeWorlds):
-        return PlatfeBothSidedBox.get_by_coordinates(session, x, y, z, world) is None
+        return await PlatfeBothSidedBox.get_ref_at(session, x, y, z, world) is None
+
+    def to_ref(self, currency_id: typing.Optional[int]) -> BoxRef:
+        return BoxRef(
+            self.id, self.world_id, self.x, self.y, self.z,
+            self.mc_item_id, self.mc_item_tag, self.count, self.price_buy, self.price_sell,
+            self.payer_acc_id, self.main_acc_id, currency_id, bool(self.blocked)
+        )
+
+    @staticmethod
+    async def load_index(session: AsyncSession):
+        async with box_index.lock:
+            if box_index.loaded:
+                return
+            generation = box_index.generation
+            r = await session.execute(
+                sa.select(
+                    PlatfeBothSidedBox.id, PlatfeBothSidedBox.world_id,
+                    PlatfeBothSidedBox.x, PlatfeBothSidedBox.y, PlatfeBothSidedBox.z,
+                    PlatfeBothSidedBox.mc_item_id, PlatfeBothSidedBox.mc_item_tag, PlatfeBothSidedBox.count,
+                    PlatfeBothSidedBox.price_buy, PlatfeBothSidedBox.price_sell,
+                    PlatfeBothSidedBox.payer_acc_id, PlatfeBothSidedBox.main_acc_id,
+                    PlatfeAccounts.currency_id, PlatfeBothSidedBox.blocked
+                )
+                .join(PlatfeAccounts, PlatfeAccounts.id == PlatfeBothSidedBox.payer_acc_id)
+                .where(PlatfeBothSidedBox.disabled == sa.false())
+            )
+            box_index.fill([BoxRef(*row[:-1], bool(row[-1])) for row in r.all()], generation)
+
+    @staticmethod
+    async def get_ref_at(session: AsyncSession, x, y, z, world) -> typing.Optional[BoxRef]:
+        if not box_index.loaded:
+            await PlatfeBothSidedBox.load_index(session)
+        return box_index.at(world.id, x, y, z)
+
+    @staticmethod
+    async def get_refs(session: AsyncSession, box_ids: typing.Iterable[int]) -> typing.Dict[int, BoxRef]:
+        if not box_index.loaded:
+            await PlatfeBothSidedBox.load_index(session)
+        return {box_id: box_index.get(box_id) for box_id in set(box_ids) if box_index.get(box_id) is not None}
+
+    @staticmethod
+    async def get_best_prices(session: AsyncSession, world, currency, item: str, side: str, limit: int) -> typing.List[BoxRef]:
+        if not box_index.loaded:
+            await PlatfeBothSidedBox.load_index(session)
+        return box_index.best_prices(world.id, currency.id, item, side, limit)
+
+    @staticmethod
+    async def get_refs_in_area(session: AsyncSession, world, x1, z1, x2, z2) -> typing.List[BoxRef]:
+        if not box_index.loaded:
+            await PlatfeBothSidedBox.load_index(session)
+        return box_index.in_area(world.id, x1, z1, x2, z2)
 
     @staticmethod
     async def create(
@@ -763,7 +1500,8 @@ class PlatfeBothSidedBox(Base):
             payer_acc: PlatfeAccounts, main_acc: PlatfeAccounts,
             mc_item_id: str, mc_item_tag: str,
             count: int,
-            price_buy: int, price_sell: typing.Optional[int] = None
+            price_buy: int, price_sell: typing.Optional[int] = None,
+            period: typing.Optional[dt.timedelta] = None, tax_amount: int = 0
     ):
 
         if len(mc_item_id) > 256 or len(mc_item_tag) > 2048:
@@ -772,6 +1510,11 @@ class PlatfeBothSidedBox(Base):
         if not await PlatfeBothSidedBox.check_xyz(session, x, y, z, world):
             return -4
 
+        # индекс обновляется только после коммита, параллельную регистрацию в этой же точке видно лишь в базе
+        if await PlatfeBothSidedBox.lock_coordinates(session, x, y, z, world):
+            return -4
+
+        now = dt.datetime.now()
         box = PlatfeBothSidedBox(
             x=x, y=y, z=z,
             world_id=world.id,
@@ -781,10 +1524,17 @@ class PlatfeBothSidedBox(Base):
             mc_item_tag=mc_item_tag,
             count=count,
             price_buy=price_buy,
-            price_sell=price_sell
+            price_sell=price_sell,
+            last_duty_timestamp=now,
+            next_due_timestamp=now + period if period else None,
+            period=period,
+            tax_amount=tax_amount
         )
         session.add(box)
-        await session.refresh(box)
+        await session.flush()
+        box_id, next_due, ref = box.id, box.next_due_timestamp, box.to_ref(payer_acc.currency_id)
+        after_commit(session, lambda: due_queue.schedule("box", box_id, next_due))
+        after_commit(session, lambda: box_index.put(ref))
         return box.id
 
     @staticmethod
@@ -800,9 +1550,52 @@ class PlatfeBothSidedBox(Base):
         r = await session.execute(
             sa.select(PlatfeBothSidedBox)
             .where(sa.and_(
-                not PlatfeBothSidedBox.disabled,
-                not PlatfeBothSidedBox.blocked
+                PlatfeBothSidedBox.disabled == sa.false(),
+                PlatfeBothSidedBox.blocked == sa.false()
+            ))
+        )
+        return r.scalars().all()
+
+    @staticmethod
+    async def get_not_blocked_chunk(session: AsyncSession, after_id: int, limit: int = SETTLE_CHUNK_SIZE):
+        r = await session.execute(
+            sa.select(PlatfeBothSidedBox)
+            .where(sa.and_(
+                PlatfeBothSidedBox.id > after_id,
+                PlatfeBothSidedBox.disabled == sa.false(),
+                PlatfeBothSidedBox.blocked == sa.false()
+            ))
+            .order_by(PlatfeBothSidedBox.id)
+            .limit(limit)
+        )
+        return r.scalars().all()
+
+    @staticmethod
+    async def get_due_ids(session: AsyncSession, until: dt.datetime):
+        r = await session.execute(
+            sa.select(PlatfeBothSidedBox.id, PlatfeBothSidedBox.next_due_timestamp)
+            .where(sa.and_(
+                PlatfeBothSidedBox.next_due_timestamp <= until,
+                PlatfeBothSidedBox.disabled == sa.false(),
+                PlatfeBothSidedBox.blocked == sa.false()
+            ))
+        )
+        return r.tuples().all()
+
+    @staticmethod
+    async def get_unscheduled_chunk(session: AsyncSession, after_id: int, limit: int = SETTLE_CHUNK_SIZE):
+        # коробки с арендой, созданные до появления next_due_timestamp
+        r = await session.execute(
+            sa.select(PlatfeBothSidedBox)
+            .where(sa.and_(
+                PlatfeBothSidedBox.id > after_id,
+                PlatfeBothSidedBox.next_due_timestamp.is_(None),
+                PlatfeBothSidedBox.period.is_not(None),
+                PlatfeBothSidedBox.disabled == sa.false(),
+                PlatfeBothSidedBox.blocked == sa.false()
             ))
+            .order_by(PlatfeBothSidedBox.id)
+            .limit(limit)
         )
         return r.scalars().all()
 
@@ -823,6 +1616,8 @@ class PlatfeBothSidedBox(Base):
             .values(disabled=True)
             .where(PlatfeBothSidedBox.id == self.id)
         )
+        box_id = self.id
+        after_commit(session, lambda: box_index.remove(box_id))
 
     async def block(self, session: AsyncSession):
         await session.execute(
@@ -830,29 +1625,216 @@ class PlatfeBothSidedBox(Base):
             .values(blocked=True)
             .where(PlatfeBothSidedBox.id == self.id)
         )
+        box_id = self.id
+        after_commit(session, lambda: box_index.update(box_id, blocked=True))
 
-    async def check(self, session: AsyncSession):
-        payer_acc = await PlatfeAccounts.get_by_id(session, self.payer_acc_id)
-        owner_acc = await PlatfeAccounts.get_by_id(session, self.main_acc_id)
+    @staticmethod
+    async def get_by_ids(session: AsyncSession, box_ids: typing.Iterable[int]):
+        r = await session.execute(
+            sa.select(PlatfeBothSidedBox)
+            .where(sa.and_(
+                PlatfeBothSidedBox.id.in_(set(box_ids)),
+                PlatfeBothSidedBox.disabled == sa.false()
+            ))
+        )
+        return {box.id: box for box in r.scalars().all()}
 
-        if payer_acc is None or owner_acc is None:
-            await self.disable(session)
+    @staticmethod
+    async def trade(session: AsyncSession, usr: PlatfeUser, acc: PlatfeAccounts,
+                    items: typing.List[typing.Tuple[int, str, int]]) -> typing.List[int]:
+        # Корзина сделок (id коробки, "buy" - игрок покупает из коробки / "sell" - продаёт в неё, количество)
+        # в одной транзакции. Вызывающий должен держать box_locks.hold по всем коробкам корзины до коммита:
+        # остатки коробок проверяются по прочитанным значениям, строки коробок в базе не блокируются.
+        # Счета блокируются одним запросом, балансы и остатки обновляются общими UPDATE ... CASE id.
+        # Для каждой сделки возвращается код из TRADE_STATUS.
+        boxes = await PlatfeBothSidedBox.get_by_ids(session, [box_id for box_id, _, _ in items])
+        locked = await PlatfeAccounts.lock(session, {acc.id} | {box.payer_acc_id for box in boxes.values()}, usr)
+        balances = {acc_id: a.balance for acc_id, (a, _) in locked.items()}
+        stock = {box.id: box.count for box in boxes.values()}
+
+        statuses = []
+        deltas: typing.Dict[int, int] = {}
+        trades = []
+        for box_id, side, count in items:
+            box = boxes.get(box_id)
+            price = None if box is None else box.price_buy if side == "buy" else box.price_sell
+            if count <= 0:
+                status = -1
+            elif box is None:
+                status = -8
+            elif box.blocked:
+                status = -9
+            elif price is None:
+                status = -10
+            elif acc.id not in locked or box.payer_acc_id not in locked:
+                status = -5
+            else:
+                player, is_owner = locked[acc.id]
+                shop, _ = locked[box.payer_acc_id]
+                src, des = (player, shop) if side == "buy" else (shop, player)
+                total = price * count
+                if player.disabled or shop.disabled:
+                    status = -5
+                elif player.id == shop.id:
+                    status = -7
+                elif src.blocked:
+                    status = -4
+                elif player.currency_id != shop.currency_id:
+                    status = -3
+                elif side == "buy" and stock[box.id] < count:
+                    status = -11
+                elif balances[src.id] - total < 0:
+                    status = -2
+                elif not is_owner:
+                    status = -6
+                else:
+                    status = 0
+                    balances[src.id] -= total
+                    balances[des.id] += total
+                    deltas[src.id] = deltas.get(src.id, 0) - total
+                    deltas[des.id] = deltas.get(des.id, 0) + total
+                    stock[box.id] += -count if side == "buy" else count
+                    trades.append((box.id, src, des, count, price))
+            statuses.append(status)
+
+        if not trades:
+            return statuses
+
+        await PlatfeAccounts.apply_deltas(session, deltas)
+        box_logs = []
+        for box_id, src, des, count, price in trades:
+            # id записи перевода нужен логу коробки, поэтому переводы пишутся по одному
+            log_id = await PlatfeMoneyTransferLog.create(session, usr, src, des, count * price)
+            box_logs.append({
+                "transfer_log_id": log_id,
+                "both_sided_box_id": box_id,
+                "count": count,
+                "price_one": price
+            })
+        await session.execute(sa.insert(PlatfeBothSidedBoxLogs), box_logs)
+
+        counts = {box_id: stock[box_id] - boxes[box_id].count for box_id, *_ in trades}
+        counts = {box_id: delta for box_id, delta in counts.items() if delta != 0}
+        if counts:
+            await session.execute(
+                sa.update(PlatfeBothSidedBox)
+                .values(count=PlatfeBothSidedBox.count + sa.case(counts, value=PlatfeBothSidedBox.id, else_=0))
+                .where(PlatfeBothSidedBox.id.in_(counts.keys()))
+                .execution_options(synchronize_session=False)
+            )
 
-        while payer_acc.balance - self.tax_amount >= 0 and self.last_duty_timestamp + self.period < dt.datetime.now():
-            self.last_duty_timestamp += self.period
-            await payer_acc.system_transfer(session, owner_acc, self.tax_amount)
+            new_counts = {box_id: stock[box_id] for box_id in counts}
 
-        if payer_acc.balance - self.tax_amount < 0 and self.last_duty_timestamp + self.period < dt.datetime.now():
-            await self.block(session)
+            def update_index():
+                for box_id, count in new_counts.items():
+                    box_index.update(box_id, count=count)
+            after_commit(session, update_index)
+        return statuses
+
+    async def check(self, session: AsyncSession):
+        await PlatfeBothSidedBox.settle(session, [self])
 
     @staticmethod
-    async def check_all(session: AsyncSession):
-        cors = []
-        for record in await PlatfeBothSidedBox.get_all_not_blocked(session):
-            cors.append(record.check(session))
+    async def settle(session: AsyncSession, boxes: typing.List["PlatfeBothSidedBox"], now: dt.datetime = None):
+        # Аренда за все прошедшие периоды считается сразу: сколько периодов прошло, сколько из них
+        # плательщик может оплатить, и одним переводом на коробку. Счета всех коробок блокируются одним запросом,
+        # балансы, логи и состояния коробок обновляются несколькими общими запросами.
+        # Возвращает {id: когда наступит следующий период}, None - коробку больше не нужно проверять.
+        if now is None:
+            now = dt.datetime.now()
+        locked = await PlatfeAccounts.lock(
+            session, {box.payer_acc_id for box in boxes} | {box.main_acc_id for box in boxes}
+        )
+        balances = {acc_id: acc.balance for acc_id, (acc, _) in locked.items() if not acc.disabled}
+
+        deltas: typing.Dict[int, int] = {}
+        logs = []
+        timestamps: typing.Dict[int, dt.datetime] = {}
+        next_due: typing.Dict[int, typing.Optional[dt.datetime]] = {}
+        blocked = []
+        disabled = []
+        for box in boxes:
+            if box.payer_acc_id not in balances or box.main_acc_id not in balances:
+                disabled.append(box.id)
+                next_due[box.id] = None
+                continue
+
+            due = due_periods(box.last_duty_timestamp, box.period, now)
+            if due == 0:
+                next_due[box.id] = box.last_duty_timestamp + box.period if box.period else None
+                continue
+
+            if box.tax_amount > 0:
+                paid = min(due, max(balances[box.payer_acc_id], 0) // box.tax_amount)
+            else:
+                paid = due
+            if paid > 0:
+                timestamps[box.id] = box.last_duty_timestamp + paid * box.period
+                charge = paid * box.tax_amount
+                if charge > 0:
+                    balances[box.payer_acc_id] -= charge
+                    balances[box.main_acc_id] += charge
+                    deltas[box.payer_acc_id] = deltas.get(box.payer_acc_id, 0) - charge
+                    deltas[box.main_acc_id] = deltas.get(box.main_acc_id, 0) + charge
+                    logs.append({
+                        "doer_id": None,
+                        "doer_account_id": box.payer_acc_id,
+                        "destination_account_id": box.main_acc_id,
+                        "count": charge
+                    })
+            if paid < due:
+                blocked.append(box.id)
+                next_due[box.id] = None
+            else:
+                next_due[box.id] = timestamps[box.id] + box.period
+
+        await PlatfeAccounts.apply_deltas(session, deltas)
+        if logs:
+            await session.execute(sa.insert(PlatfeMoneyTransferLog), logs)
+        if timestamps:
+            await session.execute(
+                sa.update(PlatfeBothSidedBox)
+                .values(last_duty_timestamp=sa.case(timestamps, value=PlatfeBothSidedBox.id))
+                .where(PlatfeBothSidedBox.id.in_(timestamps.keys()))
+                .execution_options(synchronize_session=False)
+            )
+        changed = {box.id: next_due[box.id] for box in boxes if next_due[box.id] != box.next_due_timestamp}
+        if changed:
+            await session.execute(
+                sa.update(PlatfeBothSidedBox)
+                .values(next_due_timestamp=sa.case(changed, value=PlatfeBothSidedBox.id))
+                .where(PlatfeBothSidedBox.id.in_(changed.keys()))
+                .execution_options(synchronize_session=False)
+            )
+        for ids, values in ((blocked, {"blocked": True}), (disabled, {"disabled": True})):
+            if ids:
+                await session.execute(
+                    sa.update(PlatfeBothSidedBox)
+                    .values(**values)
+                    .where(PlatfeBothSidedBox.id.in_(ids))
+                    .execution_options(synchronize_session=False)
+                )
+
+        def update_index():
+            for box_id in blocked:
+                box_index.update(box_id, blocked=True)
+            for box_id in disabled:
+                box_index.remove(box_id)
+        after_commit(session, update_index)
+        return next_due
 
-        await asyncio.gather(*cors)
-        await session.commit()
+    @staticmethod
+    async def check_all(session: AsyncSession):
+        # коробки идут по id кусками, каждый кусок рассчитывается и коммитится отдельно
+        now = dt.datetime.now()
+        after_id = 0
+        while True:
+            boxes = await PlatfeBothSidedBox.get_not_blocked_chunk(session, after_id)
+            if not boxes:
+                break
+            after_id = boxes[-1].id
+            await PlatfeBothSidedBox.settle(session, boxes, now)
+            await session.commit()
 
 
 
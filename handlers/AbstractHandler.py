@@ -1,11 +1,99 @@
 import time
+import typing
+
+from jsonschema.validators import validator_for
+
+from db.db import session_maker
+from db.tables import PlatfeUser
+from utils import principals
+from utils.PrincipalRegistry import Principal
+from web.connections import connections
+
+_compiled_validators: typing.Dict[type, typing.Callable[[typing.Any], bool]] = {}
+
+
+def _is_string_object_schema(schema: dict):
+    if set(schema) - {"type", "required", "properties"} or schema.get("type") != "object":
+        return False
+    if not all(isinstance(k, str) for k in schema.get("required", [])):
+        return False
+    return all(p == {"type": "string"} for p in schema.get("properties", {}).values())
+
+
+def compile_schema(schema: typing.Optional[dict]) -> typing.Callable[[typing.Any], bool]:
+    if schema is None:
+        return lambda data: True
+
+    if _is_string_object_schema(schema):
+        # быстрый путь для самой частой формы: объект с обязательными строковыми полями
+        required = tuple(schema.get("required", []))
+        string_fields = tuple(schema.get("properties", {}))
+
+        def check(data):
+            if not isinstance(data, dict):
+                return False
+            for k in required:
+                if k not in data:
+                    return False
+            for k in string_fields:
+                if k in data and not isinstance(data[k], str):
+                    return False
+            return True
+
+        return check
+
+    cls = validator_for(schema)
+    cls.check_schema(schema)
+    return cls(schema).is_valid
 
 
 class AbstractHandler:
+    schema: typing.Optional[dict] = None
+    # immediate: выполняется сразу в цикле чтения сокета (дешёвые служебные сообщения)
+    # sequential: дожидается всех предыдущих сообщений соединения и задерживает последующие
+    # binary: принимает двоичные кадры (web.BinaryFrame), jsn["data"] - memoryview с данными кадра
+    immediate: bool = False
+    sequential: bool = False
+    binary: bool = False
 
     def __init__(self):
         self.id = "AbstractHandler"
 
+    @classmethod
+    def compile_schema(cls):
+        validator = _compiled_validators.get(cls)
+        if validator is None:
+            validator = compile_schema(cls.schema)
+            _compiled_validators[cls] = validator
+        return validator
+
+    def validate(self, data) -> bool:
+        return self.compile_schema()(data)
+
+    async def get_principal(self, c) -> typing.Optional[Principal]:
+        if not c.authed:
+            return None
+
+        if principals.auth_epoch(c.user_id) != c.auth_epoch:
+            # токен сброшен или пользователь отключён после логина
+            c.authed = False
+            c.principal = None
+            connections.unbind(c)
+            return None
+
+        p = c.principal
+        if p is None or not p.is_fresh(principals.ttl):
+            async with session_maker() as session:
+                p = await PlatfeUser.get_principal(session, c.user_id)
+            c.principal = p
+
+        if p is None or p.disabled:
+            c.authed = False
+            c.principal = None
+            connections.unbind(c)
+            return None
+        return p
+
     def generate_response(self, c, jsn):
         c.refresh()
         return {
@@ -0,0 +1,90 @@
+import typing
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from db.db import session_maker
+from handlers.AbstractHandler import AbstractHandler
+from utils.RegistryChangeLog import RegistryChangeLog
+from utils.UpdateHashRegistry import UpdateHashRegistry
+from web.PlatfeNotifier import PlatfeNotifier
+
+
+class AbstractRegistryHandler(AbstractHandler):
+    schema = {
+        "type": "object",
+        "required": ["$hash", "$destination"],
+        "properties": {
+            "$hash": {
+                "type": "string"
+            },
+            "$destination": {
+                "type": "string"
+            }
+        }
+    }
+
+    registry: UpdateHashRegistry
+    changelog: RegistryChangeLog
+    # полный снимок больше этого числа ключей уходит несколькими кадрами; None - одним кадром
+    chunk_size: typing.Optional[int] = None
+
+    async def build_registry(self, session: AsyncSession) -> dict:
+        return {}
+
+    async def handle(self, c, jsn: dict):
+        if not self.validate(jsn.get("data")):
+            return
+
+        if not c.authed:
+            await PlatfeNotifier.send(c, jsn["data"]["$destination"], {"message": "you don't authed."})
+            return
+
+        hsh = self.registry.get("status")
+        client_hsh = jsn["data"]["$hash"]
+        if client_hsh == str(hsh):
+            return
+
+        p = await self.snapshot(hsh)
+        # клиенту с известной версией отправляем только изменения, иначе полный снимок
+        delta = self.changelog.since(client_hsh) if self.changelog.version == hsh else None
+        for p in self.frames(p, delta, hsh):
+            await PlatfeNotifier.send(c, jsn["data"]["$destination"], p)
+
+    async def snapshot(self, hsh: str) -> dict:
+        # версия не менялась - готовый снимок отдаётся без запросов к базе
+        if self.changelog.version == hsh:
+            return self.changelog.snapshot
+        async with session_maker() as session:
+            p = await self.build_registry(session)
+        return self.changelog.observe(hsh, p)
+
+    def frames(self, p: dict, delta: typing.Optional[dict], hsh: str) -> typing.List[dict]:
+        if delta is not None:
+            delta["$hash"] = hsh
+            return [delta]
+        if self.chunk_size is None or len(p) <= self.chunk_size:
+            p = dict(p)
+            p["$hash"] = hsh
+            return [p]
+
+        # большой снимок режется на части; клиент собирает их по $chunk / $chunks одной версии $hash
+        keys = list(p)
+        n = (len(keys) + self.chunk_size - 1) // self.chunk_size
+        frames = []
+        for i in range(n):
+            f = {k: p[k] for k in keys[i * self.chunk_size:(i + 1) * self.chunk_size]}
+            f["$hash"] = hsh
+            f["$chunk"] = i
+            f["$chunks"] = n
+            frames.append(f)
+        return frames
+
+    async def broadcast(self):
+        # реестр собирается один раз и одинаковым кадром уходит всем авторизованным соединениям;
+        # если предыдущая версия известна, рассылается только разница с ней
+        previous = self.changelog.version
+        hsh = self.registry.get("status")
+        p = await self.snapshot(hsh)
+        delta = self.changelog.since(previous) if previous is not None and self.changelog.version == hsh else None
+        for p in self.frames(p, delta, hsh):
+            await PlatfeNotifier.broadcast(self.id, p)
@@ -0,0 +1,83 @@
+from db.db import session_maker
+from db.tables import PlatfeBothSidedBox, PlatfeWorlds, PlatfeCurrencies
+from handlers.AbstractHandler import AbstractHandler
+
+from web.PlatfeNotifier import PlatfeNotifier
+
+# наибольшее число коробок в ответе
+MAX_BEST_PRICES = 50
+
+
+class BestPricesHandler(AbstractHandler):
+    schema = {
+        "type": "object",
+        "required": ["$world", "$currency", "$item", "$side", "$destination"],
+        "properties": {
+            "$world": {
+                "type": "string"
+            },
+            "$currency": {
+                "type": "string"
+            },
+            "$item": {
+                "type": "string"
+            },
+            "$side": {
+                "type": "string",
+                "enum": ["buy", "sell"]
+            },
+            "$limit": {
+                "type": "string"
+            },
+            "$destination": {
+                "type": "string"
+            }
+        }
+    }
+
+    def __init__(self):
+        super().__init__()
+        self.id = "best_prices"
+
+    async def handle(self, c, jsn):
+        if not self.validate(jsn.get("data")):
+            return
+
+        if not c.authed:
+            await PlatfeNotifier.send(c, jsn["data"]["$destination"], {"message": "You don't authed."})
+            return
+
+        data = jsn["data"]
+        try:
+            limit = int(data.get("$limit", "10"))
+        except ValueError:
+            await PlatfeNotifier.send(c, data["$destination"], {"message": "Error request."})
+            return
+        limit = max(1, min(limit, MAX_BEST_PRICES))
+
+        async with session_maker() as session:
+            world = await PlatfeWorlds.get_world_ref(session, data["$world"])
+            if world is None:
+                await PlatfeNotifier.send(c, data["$destination"], {"message": "Undefined world."})
+                return
+            currency = await PlatfeCurrencies.get_ref_by_short_name(session, data["$currency"])
+            if currency is None:
+                await PlatfeNotifier.send(c, data["$destination"], {"message": "Undefined currency."})
+                return
+            boxes = await PlatfeBothSidedBox.get_best_prices(
+                session, world, currency, data["$item"], data["$side"], limit
+            )
+
+        await PlatfeNotifier.send(c, data["$destination"], {
+            "world": world.world,
+            "currency": currency.short_name,
+            "item": data["$item"],
+            "side": data["$side"],
+            "boxes": [{
+                "id": str(b.id),
+                "x": str(b.x), "y": str(b.y), "z": str(b.z),
+                "tag": b.mc_item_tag,
+                "count": str(b.count),
+                "price": str(b.price_buy if data["$side"] == "buy" else b.price_sell)
+            } for b in boxes]
+        })
@@ -1,82 +1,84 @@
-from jsonschema.exceptions import ValidationError
-from jsonschema.validators import validate
+import sqlalchemy as sa
 
 from db.db import session_maker
 from db.statuses import BOX_SIDED_CREATION_STATUSES
-from db.tables import PlatfeUser, PlatfeAccounts, PlatfeBothSidedBox, PlatfeWorlds
+from db.tables import PlatfeAccounts, PlatfeBothSidedBox, PlatfeWorlds
 from handlers.AbstractHandler import AbstractHandler
 
 from web.PlatfeNotifier import PlatfeNotifier
 
 
-class AddPrefixToPlayerHandler(AbstractHandler):
+class BoxRegisterHandler(AbstractHandler):
+    schema = {
+        "type": "object",
+        "required": [
+            "$x", "$y", "$z", "$world",
+            "$acc_name", "$minecraft_item", "$minecraft_tag",
+            "$count", "$buy", "$sell", "$destination"
+        ],
+        "properties": {
+            "$x": {
+                "type": "string"
+            },
+            "$y": {
+                "type": "string"
+            },
+            "$z": {
+                "type": "string"
+            },
+            "$world": {
+                "type": "string"
+            },
+            "$acc_name": {
+                "type": "string"
+            },
+            "$minecraft_item": {
+                "type": "string"
+            },
+            "$minecraft_tag": {
+                "type": "string"
+            },
+            "$count": {
+                "type": "string"
+            },
+            "$buy": {
+                "type": "string"
+            },
+            "$sell": {
+                "type": "string"
+            },
+            "$destination": {
+                "type": "string"
+            }
+        }
+    }
+
     def __init__(self):
         super().__init__()
         self.id = "box_register_handler"
 
     async def handle(self, c, jsn):
-        try:
-            validate(jsn.get("data"), {
-                "type": "object",
-                "required": [
-                    "$x", "$y", "$z", "$world",
-                    "$acc_name", "$minecraft_item", "$minecraft_tag",
-                    "$count", "$buy", "$sell"
-                ],
-                "properties": {
-                    "$x": {
-                        "type": "string"
-                    },
-                    "$y": {
-                        "type": "string"
-                    },
-                    "$z": {
-                        "type": "string"
-                    },
-                    "$world": {
-                        "type": "string"
-                    },
-                    "$acc_name": {
-                        "type": "string"
-                    },
-                    "$minecraft_item": {
-                        "type": "string"
-                    },
-                    "$minecraft_tag": {
-                        "type": "string"
-                    },
-                    "$count": {
-                        "type": "string"
-                    },
-                    "$buy": {
-                        "type": "string"
-                    },
-                    "$sell": {
-                        "type": "string"
-                    }
-                }
-            })
-        except ValidationError:
+        if not self.validate(jsn.get("data")):
             return
 
-        if not c.authed:
+        principal = await self.get_principal(c)
+        if principal is None:
             await PlatfeNotifier.send(c, jsn["data"]["$destination"], {"message": "You don't authed."})
             return
 
         data = jsn["data"]
 
         async with session_maker() as session:
-            usr = await PlatfeUser.get_by_id(session, c.user_id)
             acc = await PlatfeAccounts.get_by_name(session, data["$acc_name"])
             if acc is None:
                 await PlatfeNotifier.send(c, data["$destination"], {"message": "Account don't found."})
                 return
 
-            if usr not in acc.get_owners(session):
+            if acc.id not in principal.account_ids:
                 await PlatfeNotifier.send(c, data["$destination"], {"message": "Account don't your."})
                 return
 
-            world = await PlatfeWorlds.get_world(session, data["$world"])
+            world = await PlatfeWorlds.get_world_ref(session, data["$world"])
 
             if world is None:
                 await PlatfeNotifier.send(c, data["$destination"], {"message": "Undefined world."})
@@ -91,18 +93,27 @@ class AddPrefixToPlayerHandler(AbstractHandler):
                 await PlatfeNotifier.send(c, data["$destination"], {"message": "Error request."})
                 return
 
-            r = await PlatfeBothSidedBox.create(
-                session,
-                x, y, z, world,
-                acc, await PlatfeAccounts.get_by_id(session, 1),
-                data["$minecraft_item"], data["$minecraft_tag"],
-                count, buy, sell
-            )
+            try:
+                r = await PlatfeBothSidedBox.create(
+                    session,
+                    x, y, z, world,
+                    acc, await PlatfeAccounts.get_by_id(session, 1),
+                    data["$minecraft_item"], data["$minecraft_tag"],
+                    count, buy, sell
+                )
+                if r > 0:
+                    # create возвращает id новой коробки
+                    await session.commit()
+            except sa.exc.DBAPIError:
+                # две регистрации на одних координатах берут один и тот же gap lock,
+                # и InnoDB снимает одну из них deadlock'ом: координаты уже заняты
+                await session.rollback()
+                r = -4
+
             if r < 0:
-                await PlatfeNotifier.send(c, data["$destination"], {"message": BOX_SIDED_CREATION_STATUSES[r]})
                 await session.rollback()
+                await PlatfeNotifier.send(c, data["$destination"], {"message": BOX_SIDED_CREATION_STATUSES[r]})
                 return
             else:
-                await PlatfeNotifier.send(c, data["$destination"], {"message": BOX_SIDED_CREATION_STATUSES[r]})
-                await session.commit()
-                return
\ No newline at end of file
+                await PlatfeNotifier.send(c, data["$destination"], {"message": BOX_SIDED_CREATION_STATUSES[0]})
+                return
@@ -0,0 +1,81 @@
+from db.db import session_maker
+from db.tables import PlatfeBothSidedBox, PlatfeWorlds
+from handlers.AbstractHandler import AbstractHandler
+from utils.BoxIndex import CHUNK_SHIFT
+
+from web.PlatfeNotifier import PlatfeNotifier
+
+# наибольшая сторона запрашиваемой области в чанках
+MAX_AREA_CHUNKS = 32
+
+
+class BoxesInAreaHandler(AbstractHandler):
+    schema = {
+        "type": "object",
+        "required": ["$world", "$x1", "$z1", "$x2", "$z2", "$destination"],
+        "properties": {
+            "$world": {
+                "type": "string"
+            },
+            "$x1": {
+                "type": "string"
+            },
+            "$z1": {
+                "type": "string"
+            },
+            "$x2": {
+                "type": "string"
+            },
+            "$z2": {
+                "type": "string"
+            },
+            "$destination": {
+                "type": "string"
+            }
+        }
+    }
+
+    def __init__(self):
+        super().__init__()
+        self.id = "boxes_in_area"
+
+    async def handle(self, c, jsn):
+        if not self.validate(jsn.get("data")):
+            return
+
+        if not c.authed:
+            await PlatfeNotifier.send(c, jsn["data"]["$destination"], {"message": "You don't authed."})
+            return
+
+        data = jsn["data"]
+        try:
+            x1, z1, x2, z2 = list(map(int, [data["$x1"], data["$z1"], data["$x2"], data["$z2"]]))
+        except ValueError:
+            await PlatfeNotifier.send(c, data["$destination"], {"message": "Error request."})
+            return
+
+        if abs((x2 >> CHUNK_SHIFT) - (x1 >> CHUNK_SHIFT)) >= MAX_AREA_CHUNKS or \
+                abs((z2 >> CHUNK_SHIFT) - (z1 >> CHUNK_SHIFT)) >= MAX_AREA_CHUNKS:
+            await PlatfeNotifier.send(c, data["$destination"], {"message": "Area too large."})
+            return
+
+        async with session_maker() as session:
+            world = await PlatfeWorlds.get_world_ref(session, data["$world"])
+            if world is None:
+                await PlatfeNotifier.send(c, data["$destination"], {"message": "Undefined world."})
+                return
+            boxes = await PlatfeBothSidedBox.get_refs_in_area(session, world, x1, z1, x2, z2)
+
+        await PlatfeNotifier.send(c, data["$destination"], {
+            "world": world.world,
+            "boxes": [{
+                "id": str(b.id),
+                "x": str(b.x), "y": str(b.y), "z": str(b.z),
+                "item": b.mc_item_id,
+                "tag": b.mc_item_tag,
+                "count": str(b.count),
+                "buy": "" if b.price_buy is None else str(b.price_buy),
+                "sell": "" if b.price_sell is None else str(b.price_sell),
+                "blocked": "1" if b.blocked else "0"
+            } for b in boxes]
+        })
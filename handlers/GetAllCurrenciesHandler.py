@@ -1,6 +1,3 @@
-from jsonschema.exceptions import ValidationError
-from jsonschema.validators import validate
-
 from db.db import session_maker
 from db.tables import *
 from handlers.AbstractHandler import AbstractHandler
@@ -8,22 +5,22 @@ from web.PlatfeNotifier import PlatfeNotifier
 
 
 class GetAllCurrenciesHandler(AbstractHandler):
+    schema = {
+        "type": "object",
+        "required": ["$destination"],
+        "properties": {
+            "$destination": {
+                "type": "string"
+            }
+        }
+    }
+
     def __init__(self):
         super().__init__()
         self.id = "get_currencies"
 
     async def handle(self, c, jsn: dict):
-        try:
-            validate(jsn.get("data"), {
-                "type": "object",
-                "required": ["$destination"],
-                "properties": {
-                    "$destination": {
-                        "type": "string"
-                    }
-                }
-            })
-        except ValidationError:
+        if not self.validate(jsn.get("data")):
             return
 
         if not c.authed:
@@ -31,5 +28,5 @@ class GetAllCurrenciesHandler(AbstractHandler):
             return
 
         async with session_maker() as session:
-            currencies = {c.name: c.short_name for c in await PlatfeCurrencies.get_all(session)}
+            currencies = {c.name: c.short_name for c in await PlatfeCurrencies.get_all_refs(session)}
             await PlatfeNotifier.send(c, jsn["data"]["$destination"], currencies)
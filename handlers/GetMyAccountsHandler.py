@@ -1,6 +1,3 @@
-from jsonschema.exceptions import ValidationError
-from jsonschema.validators import validate
-
 from db.db import session_maker
 from db.tables import *
 from handlers.AbstractHandler import AbstractHandler
@@ -8,28 +5,29 @@ from web.PlatfeNotifier import PlatfeNotifier
 
 
 class GetMyAccountsHandler(AbstractHandler):
+    schema = {
+        "type": "object",
+        "required": ["$destination"],
+        "properties": {
+            "$destination": {
+                "type": "string"
+            }
+        }
+    }
+
     def __init__(self):
         super().__init__()
         self.id = "get_my_accounts"
 
     async def handle(self, c, jsn: dict):
-        try:
-            validate(jsn.get("data"), {
-                "type": "object",
-                "required": ["$destination"],
-                "properties": {
-                    "$destination": {
-                        "type": "string"
-                    }
-                }
-            })
-        except ValidationError:
+        if not self.validate(jsn.get("data")):
             return
 
-        if not c.authed:
+        principal = await self.get_principal(c)
+        if principal is None:
             await PlatfeNotifier.send(c, jsn["data"]["$destination"], {"message": "you don't authed."})
             return
 
         async with session_maker() as session:
-            t = {a.name: str(a.balance) + (await PlatfeCurrencies.get_by_id(session, a.currency_id)).short_name for a in await PlatfeAccounts.get_all_user_accounts(session, await PlatfeUser.get_by_id(session, c.user_id))}
+            t = {a.name: str(a.balance) + (await PlatfeCurrencies.get_ref(session, a.currency_id)).short_name for a in await PlatfeAccounts.get_all_user_accounts(session, principal.user)}
             await PlatfeNotifier.send(c, jsn["data"]["$destination"], t)
@@ -1,6 +1,3 @@
-from jsonschema.exceptions import ValidationError
-from jsonschema.validators import validate
-
 from db.db import session_maker
 from db.statuses import PAY_STATUS
 from db.tables import PlatfeUser, PlatfeNicknameStatus, PlatfeAccounts
@@ -9,37 +6,37 @@ from web.PlatfeNotifier import PlatfeNotifier
 
 
 class GetPermissionHandler(AbstractHandler):
+    schema = {
+        "type": "object",
+        "required": ["$user_name", "$destination"],
+        "properties": {
+            "$user_name": {
+                "type": "string"
+            },
+            "$destination": {
+                "type": "string"
+            }
+        }
+    }
+
     def __init__(self):
         super().__init__()
         self.id = "get_permissions"
 
     async def handle(self, c, jsn):
-        try:
-            validate(jsn.get("data"), {
-                "type": "object",
-                "required": ["$user_name", "$destination"],
-                "properties": {
-                    "$user_name": {
-                        "type": "string"
-                    },
-                    "$destination": {
-                        "type": "string"
-                    }
-                }
-            })
-        except ValidationError:
+        if not self.validate(jsn.get("data")):
             return
 
         data = jsn["data"]
         destination = data["$destination"]
 
-        if not c.authed:
+        principal = await self.get_principal(c)
+        if principal is None:
             await PlatfeNotifier.send(c, destination, {"message": "Error you don't authed."})
             return
 
         async with session_maker() as session:
-            usr = await PlatfeUser.get_by_id(session, c.user_id)
-            if not await usr.has_permission(session, "platfe.get_permissions"):
+            if not principal.has_permission("platfe.get_permissions"):
                 print("not perms")
                 return
 
@@ -1,44 +1,47 @@
 import traceback
 
-from jsonschema.exceptions import ValidationError
-
 from db.db import session_maker
 from db.tables import PlatfeUser
 from handlers.AbstractHandler import AbstractHandler
-from jsonschema import validate
+from utils import principals
 
 from web.PlatfeNotifier import PlatfeNotifier
+from web.connections import connections
 
 
 class LoginHandler(AbstractHandler):
+    sequential = True
+
+    schema = {
+        "type": "object",
+        "required": ["$nickname", "$token", "$destination"],
+        "properties": {
+            "$nickname": {
+                "type": "string",
+                "maxLength": 32,
+                "minLength": 1
+            },
+            "$token": {
+                "type": "string",
+                "maxLength": 200,
+                "minLength": 200
+            },
+            "$destination": {
+                "type": "string"
+            }
+        }
+    }
+
     def __init__(self):
         super().__init__()
         self.id = "login"
 
     async def handle(self, c, jsn: dict):
-        try:
-            validate(jsn.get("data"), {
-                "type": "object",
-                "required": ["$nickname", "$token", "$destination"],
-                "properties": {
-                    "$nickname": {
-                        "type": "string",
-                        "maxLength": 32,
-                        "mixLength": 1
-                    },
-                    "$token": {
-                        "type": "string",
-                        "maxLength": 200,
-                        "minLength": 200
-                    },
-                    "$destination": {
-                        "type": "string"
-                    }
-                }
-            })
-        except ValidationError:
+        if not self.validate(jsn.get("data")):
             # traceback.print_exc()
             c.authed = False
+            c.principal = None
+            connections.unbind(c)
             destination = jsn["data"].get("$destination")
             if not destination:
                 destination = "chat_notify"
@@ -50,9 +53,12 @@ class LoginHandler(AbstractHandler):
         async with session_maker() as session:
             authed = await PlatfeUser.check_auth(session, jsn["data"]["$nickname"], jsn["data"]["$token"])
             if authed:
-                c.user_id = authed.id
-                c.didid = authed.disid
+                c.auth_epoch = principals.auth_epoch(authed.id)
+                c.principal = await PlatfeUser.get_principal(session, authed.id, authed)
+                connections.bind(c, authed.id, authed.disid)
                 c.authed = True
+                # сохраняет хэш токена, если пользователь вошёл со старым токеном
+                await session.commit()
                 await PlatfeNotifier.send(c, jsn["data"]["$destination"], {
                     "message": "You authed!"
                 })
@@ -62,6 +68,8 @@ class LoginHandler(AbstractHandler):
 
             else:
                 c.authed = False
+                c.principal = None
+                connections.unbind(c)
                 await PlatfeNotifier.send(c, jsn["data"]["$destination"], {
                     "message": "Auth error[1]."
                 })
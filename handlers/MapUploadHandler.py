@@ -0,0 +1,75 @@
+import struct
+import typing
+
+from db.db import session_maker
+from db.tables import PlatfeMap, PlatfeWorlds, TILE_SIZE
+from handlers.AbstractHandler import AbstractHandler
+from web.PlatfeNotifier import PlatfeNotifier
+
+# Данные кадра: [длина имени мира: 1 байт][мир в utf-8], затем записи
+# [chunk_x: int32 BE][chunk_y: int32 BE][тайл: TILE_SIZE байт ascii] до конца кадра.
+TILE_HEADER = struct.Struct(">ii")
+TILE_RECORD_SIZE = TILE_HEADER.size + TILE_SIZE
+# сколько тайлов можно прислать одним кадром (укладывается в лимит сообщения aiohttp в 4 МБ)
+MAX_TILES_PER_FRAME = 4096
+
+
+def decode_tiles(data: memoryview) -> typing.Optional[typing.Tuple[str, typing.Dict[typing.Tuple[int, int], str]]]:
+    # повторы одного чанка в кадре схлопываются, остаётся последний
+    if len(data) < 1:
+        return None
+    offset = 1 + data[0]
+    body = len(data) - offset
+    if body < 0 or body % TILE_RECORD_SIZE != 0 or body // TILE_RECORD_SIZE > MAX_TILES_PER_FRAME:
+        return None
+    try:
+        world = bytes(data[1:offset]).decode("utf-8")
+        tiles = {}
+        for start in range(offset, len(data), TILE_RECORD_SIZE):
+            key = TILE_HEADER.unpack_from(data, start)
+            tiles[key] = bytes(data[start + TILE_HEADER.size:start + TILE_RECORD_SIZE]).decode("ascii")
+    except UnicodeDecodeError:
+        return None
+    return world, tiles
+
+
+class MapUploadHandler(AbstractHandler):
+    binary = True
+
+    def __init__(self):
+        super().__init__()
+        self.id = "map_upload"
+
+    async def handle(self, c, jsn):
+        if not isinstance(jsn.get("data"), memoryview):
+            return
+
+        principal = await self.get_principal(c)
+        if principal is None:
+            await PlatfeNotifier.send(c, self.id, {"message": "you don't authed."})
+            return
+
+        if not principal.has_permission("platfe.map.upload"):
+            await PlatfeNotifier.send(c, self.id, {"message": "Permission denied."})
+            return
+
+        decoded = decode_tiles(jsn["data"])
+        if decoded is None:
+            await PlatfeNotifier.send(c, self.id, {"message": "Error request."})
+            return
+        world_name, tiles = decoded
+
+        async with session_maker() as session:
+            world = await PlatfeWorlds.get_world_ref(session, world_name)
+            if world is None:
+                await PlatfeNotifier.send(c, self.id, {"message": "Undefined world."})
+                return
+
+            written = await PlatfeMap.upload(session, principal.user, world.id, tiles) if tiles else 0
+            await session.commit()
+
+        await PlatfeNotifier.send(c, self.id, {
+            "message": "Map: " + str(written) + "/" + str(len(tiles)) + " tiles written.",
+            "received": str(len(tiles)),
+            "written": str(written)
+        })
@@ -0,0 +1,118 @@
+import asyncio
+import typing
+
+from db.db import session_maker
+from db.statuses import PAY_STATUS
+from db.tables import *
+from handlers.AbstractHandler import AbstractHandler
+from web.PlatfeNotifier import PlatfeNotifier
+
+# сколько переводов можно отправить одним сообщением
+MAX_BATCH_SIZE = 1000
+
+
+class PayBatchHandler(AbstractHandler):
+    schema = {
+        "type": "object",
+        "required": ["$items", "$destination"],
+        "properties": {
+            "$items": {
+                "type": "array",
+                "minItems": 1,
+                "maxItems": MAX_BATCH_SIZE,
+                "items": {
+                    "type": "object",
+                    "required": ["$acc1", "$acc2", "$count"],
+                    "properties": {
+                        "$acc1": {
+                            "type": "string"
+                        },
+                        "$acc2": {
+                            "type": "string"
+                        },
+                        "$count": {
+                            "type": "string"
+                        }
+                    }
+                }
+            },
+            "$destination": {
+                "type": "string"
+            }
+        }
+    }
+
+    def __init__(self):
+        super().__init__()
+        self.id = "pay_batch"
+
+    async def handle(self, c, jsn):
+        if not self.validate(jsn.get("data")):
+            return
+
+        data = jsn["data"]
+
+        principal = await self.get_principal(c)
+        if principal is None:
+            await PlatfeNotifier.send(c, data["$destination"], {"message": "you don't authed."})
+            return
+
+        async with session_maker() as session:
+            accounts = await PlatfeAccounts.get_by_names(
+                session, [i["$acc1"] for i in data["$items"]] + [i["$acc2"] for i in data["$items"]]
+            )
+            items = []
+            for i in data["$items"]:
+                try:
+                    count = int(i["$count"])
+                except ValueError:
+                    count = 0
+                items.append((accounts.get(i["$acc1"]), accounts.get(i["$acc2"]), count))
+
+            # неизвестные счета отсекаются здесь, как и в одиночном pay, а не превращаются в ошибку БД
+            found = [n for n, (acc1, acc2, _) in enumerate(items) if acc1 is not None and acc2 is not None]
+            statuses = [-8] * len(items)
+            for n, status in zip(found, await PlatfeAccounts.pay_batch(session, principal.user, [items[n] for n in found])):
+                statuses[n] = status
+
+            # суммы по каждой паре счетов, чтобы каждому владельцу ушло одно сообщение на всю пачку
+            totals: typing.Dict[typing.Tuple[int, int], int] = {}
+            names: typing.Dict[int, str] = {}
+            currencies: typing.Dict[int, int] = {}
+            for (acc1, acc2, count), status in zip(items, statuses):
+                if status == 0:
+                    totals[(acc1.id, acc2.id)] = totals.get((acc1.id, acc2.id), 0) + count
+                    names[acc1.id], names[acc2.id] = acc1.name, acc2.name
+                    currencies[acc1.id] = acc1.currency_id
+
+            if totals:
+                await session.commit()
+            else:
+                await session.rollback()
+
+            await PlatfeNotifier.send(c, data["$destination"], {
+                "message": "Batch: " + str(statuses.count(0)) + "/" + str(len(statuses)) + " payments accepted.",
+                "results": [{"status": str(s), "message": PAY_STATUS[s]} for s in statuses]
+            })
+
+            if not totals:
+                return
+
+            owners = await PlatfeAccounts.get_owners_map(session, names.keys())
+            short_names = {
+                currency_id: (await PlatfeCurrencies.get_ref(session, currency_id)).short_name
+                for currency_id in set(currencies.values())
+            }
+            lines: typing.Dict[int, typing.List[str]] = {}
+            users: typing.Dict[int, PlatfeUser] = {}
+            for (acc1_id, acc2_id), count in totals.items():
+                line = names[acc1_id] + "->" + names[acc2_id] + "[" + str(count) + short_names[currencies[acc1_id]] + "]"
+                for usr in owners.get(acc1_id, []) + owners.get(acc2_id, []):
+                    users[usr.id] = usr
+                    if line not in lines.setdefault(usr.id, []):
+                        lines[usr.id].append(line)
+
+            await asyncio.gather(*[
+                PlatfeNotifier.send_to_users([usr], data["$destination"], {"message": "\n".join(lines[user_id])})
+                for user_id, usr in users.items()
+            ])
@@ -1,51 +1,50 @@
-from jsonschema.exceptions import ValidationError
-from jsonschema.validators import validate
-
 from db.db import session_maker
 from db.statuses import PAY_STATUS
 from db.tables import *
+from db.TransferCommitter import transfer_committer
 from handlers.AbstractHandler import AbstractHandler
 from web.PlatfeNotifier import PlatfeNotifier
 
 
 class PayHandler(AbstractHandler):
+    schema = {
+        "type": "object",
+        "required": ["$acc1", "$acc2", "$count", "$destination"],
+        "properties": {
+            "$acc1": {
+                "type": "string"
+            },
+            "$acc2": {
+                "type": "string"
+            },
+            "$count": {
+                "type": "string"
+            },
+            "$destination": {
+                "type": "string"
+            }
+        }
+    }
+
     def __init__(self):
         super().__init__()
         self.id = "pay"
 
     async def handle(self, c, jsn):
-        try:
-            validate(jsn.get("data"), {
-                "type": "object",
-                "required": ["$acc1", "$acc2", "$count", "$destination"],
-                "properties": {
-                    "$acc1": {
-                        "type": "string"
-                    },
-                    "$acc2": {
-                        "type": "string"
-                    },
-                    "$count": {
-                        "type": "string"
-                    },
-                    "$destination": {
-                        "type": "string"
-                    }
-                }
-            })
-        except ValidationError:
+        if not self.validate(jsn.get("data")):
             return
 
         data = jsn["data"]
 
-        if not c.authed:
+        principal = await self.get_principal(c)
+        if principal is None:
             await PlatfeNotifier.send(c, jsn["data"]["$destination"], {"message": "you don't authed."})
             return
 
         async with session_maker() as session:
-            usr = await PlatfeUser.get_by_id(session, c.user_id)
-            acc1 = await PlatfeAccounts.get_by_name(session, data["$acc1"])
-            acc2 = await PlatfeAccounts.get_by_name(session, data["$acc2"])
+            accounts = await PlatfeAccounts.get_by_names(session, [data["$acc1"], data["$acc2"]])
+            acc1 = accounts.get(data["$acc1"])
+            acc2 = accounts.get(data["$acc2"])
             count = int(data["$count"])
 
             if acc1 is None:
@@ -56,15 +55,26 @@ class PayHandler(AbstractHandler):
                 await PlatfeNotifier.send(c, data["$destination"], {"message": "Error acc2 not found."})
                 return
 
-            s = await acc1.pay(session, usr, acc2, count)
-            if s > 0:
-                await PlatfeNotifier.send_to_users(list(await acc1.get_owners(session)) + list(await acc2.get_owners(session)), data["$destination"], {
-                    "message": acc1.name + "->" + acc2.name + "[" + str(count) +
-                    (await PlatfeCurrencies.get_by_id(session, acc1.currency_id)).short_name + "]"
-                })
-                await session.commit()
-                s = 0
-            else:
+            acc_ids = [acc1.id, acc2.id]
+            message = acc1.name + "->" + acc2.name + "[" + str(count)
+            currency_id = acc1.currency_id
+
+            if transfer_committer.enabled:
+                # перевод проводится вместе с попутными переводами других соединений
                 await session.rollback()
+                s = await transfer_committer.submit(principal.user, acc_ids[0], acc_ids[1], count)
+            else:
+                s = await acc1.pay(session, principal.user, acc2, count)
+                if s > 0:
+                    # коммитим до рассылки, чтобы не держать блокировку счетов на время отправки уведомлений
+                    await session.commit()
+                    s = 0
+                else:
+                    await session.rollback()
+
+            if s == 0:
+                await PlatfeNotifier.send_to_users(await PlatfeAccounts.get_owners_of(session, acc_ids), data["$destination"], {
+                    "message": message + (await PlatfeCurrencies.get_ref(session, currency_id)).short_name + "]"
+                })
 
             await PlatfeNotifier.send(c, data["$destination"], {"message": PAY_STATUS[s]})
@@ -1,6 +1,3 @@
-from jsonschema.exceptions import ValidationError
-from jsonschema.validators import validate
-
 from db.db import session_maker
 from db.statuses import PAY_STATUS
 from db.tables import PlatfeUser, PlatfeNicknameStatus, PlatfeAccounts
@@ -9,37 +6,37 @@ from web.PlatfeNotifier import PlatfeNotifier
 
 
 class PermissionHandler(AbstractHandler):
+    schema = {
+        "type": "object",
+        "required": ["$user_name", "$destination"],
+        "properties": {
+            "$user_name": {
+                "type": "string"
+            },
+            "$destination": {
+                "type": "string"
+            }
+        }
+    }
+
     def __init__(self):
         super().__init__()
         self.id = "permission"
 
     async def handle(self, c, jsn):
-        try:
-            validate(jsn.get("data"), {
-                "type": "object",
-                "required": ["$user_name", "$destination"],
-                "properties": {
-                    "$user_name": {
-                        "type": "string"
-                    },
-                    "$destination": {
-                        "type": "string"
-                    }
-                }
-            })
-        except ValidationError:
+        if not self.validate(jsn.get("data")):
             return
 
         data = jsn["data"]
         destination = data["$destination"]
 
-        if not c.authed:
+        principal = await self.get_principal(c)
+        if principal is None:
             await PlatfeNotifier.send(c, destination, {"message": "Error you don't authed."})
             return
 
         async with session_maker() as session:
-            usr = await PlatfeUser.get_by_id(session, c.user_id)
-            if not await usr.has_permission(session, "platfe.change_permissions"):
+            if not principal.has_permission("platfe.change_permissions"):
                 print("not perms")
                 return
 
@@ -47,9 +44,9 @@ class PermissionHandler(AbstractHandler):
 
             for i, j in data.items():
                 if i[:3] == "add":
-                    e_user.add_permission(session, j)
+                    await e_user.add_permission(session, j)
                 elif i[:3] == "del":
-                    e_user.del_permission(session, j)
+                    await e_user.del_permission(session, j)
 
             await session.commit()
             await PlatfeNotifier.send(c, destination, {"message": "Permission changed"})
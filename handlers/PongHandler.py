@@ -2,11 +2,13 @@ from handlers.AbstractHandler import AbstractHandler
 
 
 class PongHandler(AbstractHandler):
+    immediate = True
+
     def __init__(self):
         super().__init__()
         self.id = "pong"
 
     async def handle(self, c, jsn):
-        c.refresh()
+        c.pong()
         return
 
@@ -0,0 +1,116 @@
+import asyncio
+import typing
+
+from db.db import session_maker
+from db.statuses import TRADE_STATUS
+from db.tables import *
+from handlers.AbstractHandler import AbstractHandler
+from utils import box_locks
+from web.PlatfeNotifier import PlatfeNotifier
+
+# сколько сделок можно отправить одной корзиной
+MAX_BASKET_SIZE = 100
+
+
+class TradeHandler(AbstractHandler):
+    schema = {
+        "type": "object",
+        "required": ["$acc_name", "$items", "$destination"],
+        "properties": {
+            "$acc_name": {
+                "type": "string"
+            },
+            "$items": {
+                "type": "array",
+                "minItems": 1,
+                "maxItems": MAX_BASKET_SIZE,
+                "items": {
+                    "type": "object",
+                    "required": ["$box", "$side", "$count"],
+                    "properties": {
+                        "$box": {
+                            "type": "string"
+                        },
+                        "$side": {
+                            "type": "string",
+                            "enum": ["buy", "sell"]
+                        },
+                        "$count": {
+                            "type": "string"
+                        }
+                    }
+                }
+            },
+            "$destination": {
+                "type": "string"
+            }
+        }
+    }
+
+    def __init__(self):
+        super().__init__()
+        self.id = "trade"
+
+    async def handle(self, c, jsn):
+        if not self.validate(jsn.get("data")):
+            return
+
+        data = jsn["data"]
+
+        principal = await self.get_principal(c)
+        if principal is None:
+            await PlatfeNotifier.send(c, data["$destination"], {"message": "you don't authed."})
+            return
+
+        items = []
+        for i in data["$items"]:
+            try:
+                box_id, count = int(i["$box"]), int(i["$count"])
+            except ValueError:
+                box_id, count = 0, 0
+            items.append((box_id, i["$side"], count))
+
+        async with session_maker() as session:
+            acc = await PlatfeAccounts.get_by_name(session, data["$acc_name"])
+            if acc is None:
+                await PlatfeNotifier.send(c, data["$destination"], {"message": "Account don't found."})
+                return
+
+            # поля счёта после коммита истекают, имя нужно для уведомлений
+            acc_name = acc.name
+
+            # замки коробок держатся до коммита, чтобы следующая сделка увидела обновлённые остатки
+            async with box_locks.hold([box_id for box_id, _, _ in items]):
+                statuses = await PlatfeBothSidedBox.trade(session, principal.user, acc, items)
+                if 0 in statuses:
+                    await session.commit()
+                else:
+                    await session.rollback()
+
+            await PlatfeNotifier.send(c, data["$destination"], {
+                "message": "Trade: " + str(statuses.count(0)) + "/" + str(len(statuses)) + " items accepted.",
+                "results": [{"status": str(s), "message": TRADE_STATUS[s]} for s in statuses]
+            })
+
+            if 0 not in statuses:
+                return
+
+            shops = await PlatfeBothSidedBox.get_refs(
+                session, [box_id for (box_id, _, _), status in zip(items, statuses) if status == 0]
+            )
+
+            # владельцам каждого магазина - одно сообщение на всю корзину
+            lines: typing.Dict[int, typing.List[str]] = {}
+            for (box_id, side, count), status in zip(items, statuses):
+                box = shops.get(box_id)
+                if status != 0 or box is None:
+                    continue
+                lines.setdefault(box.payer_acc_id, []).append(
+                    acc_name + (" bought " if side == "buy" else " sold ") + str(count) + " " + box.mc_item_id +
+                    " [" + str(box.x) + " " + str(box.y) + " " + str(box.z) + "]"
+                )
+            owners = await PlatfeAccounts.get_owners_map(session, lines.keys())
+            await asyncio.gather(*[
+                PlatfeNotifier.send_to_users(owners.get(acc_id, []), data["$destination"], {"message": "\n".join(text)})
+                for acc_id, text in lines.items()
+            ])
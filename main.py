@@ -2,6 +2,8 @@ import asyncio
 from aiohttp import web
 
 from db.db import init_db, session_maker
+from db.DueScheduler import due_scheduler
+from db.tables import PlatfeCurrencies
 from platfe_discord.bot import start_bot
 from web.app import init_func, checker
 
@@ -11,11 +13,26 @@ async def test_db():
         await session.commit()
 
 
+async def load_references():
+    try:
+        async with session_maker() as session:
+            await PlatfeCurrencies.load_references(session)
+    except Exception as e:
+        print(e)
+
+
+async def run_scheduler():
+    # первый запрос планировщика не должен обогнать создание таблиц
+    await init_db()
+    await due_scheduler.run()
+
+
 async def main():
     await asyncio.gather(
-        init_db(),
         web._run_app(init_func(), host="0.0.0.0", port=8381),
         checker(),
+        load_references(),
+        run_scheduler(),
         start_bot()
     )
 
@@ -0,0 +1,59 @@
+import time
+import typing
+
+# сколько секунд помнить удачный и неудачный логин
+AUTH_POSITIVE_TTL = 30
+AUTH_NEGATIVE_TTL = 5
+MAX_AUTH_ENTRIES = 10000
+
+
+class AuthCache:
+    # Короткоживущий кэш результатов логина по (ник, хэш токена), чтобы волна переподключений
+    # после перезапуска игровых серверов не превращалась в волну запросов к базе.
+    def __init__(self):
+        self.entries: typing.Dict[typing.Tuple[str, str], typing.Tuple[float, typing.Any]] = {}
+        self.by_name: typing.Dict[str, typing.Set[str]] = {}
+        self.generations: typing.Dict[str, int] = {}
+
+    def get(self, name: str, digest: str) -> typing.Tuple[bool, typing.Any]:
+        entry = self.entries.get((name, digest))
+        if entry is None:
+            return False, None
+        expires, user = entry
+        if expires < time.monotonic():
+            self._drop(name, digest)
+            return False, None
+        return True, user
+
+    def generation(self, name: str) -> int:
+        return self.generations.get(name, 0)
+
+    def put(self, name: str, digest: str, user, generation: int):
+        if generation != self.generation(name):
+            return
+        if len(self.entries) >= MAX_AUTH_ENTRIES:
+            self.purge()
+            if len(self.entries) >= MAX_AUTH_ENTRIES:
+                self.entries.clear()
+                self.by_name.clear()
+        ttl = AUTH_POSITIVE_TTL if user is not None else AUTH_NEGATIVE_TTL
+        self.entries[(name, digest)] = (time.monotonic() + ttl, user)
+        self.by_name.setdefault(name, set()).add(digest)
+
+    def invalidate(self, name: str):
+        self.generations[name] = self.generation(name) + 1
+        for digest in self.by_name.pop(name, ()):
+            self.entries.pop((name, digest), None)
+
+    def purge(self):
+        now = time.monotonic()
+        for name, digest in [k for k, (expires, _) in self.entries.items() if expires < now]:
+            self._drop(name, digest)
+
+    def _drop(self, name: str, digest: str):
+        self.entries.pop((name, digest), None)
+        digests = self.by_name.get(name)
+        if digests is not None:
+            digests.discard(digest)
+            if not digests:
+                del self.by_name[name]
@@ -0,0 +1,126 @@
+import asyncio
+import typing
+
+from utils.PriceIndex import PriceIndex
+
+# размер чанка Minecraft в блоках - 1 << CHUNK_SHIFT
+CHUNK_SHIFT = 4
+
+
+class BoxRef(typing.NamedTuple):
+    id: int
+    world_id: int
+    x: int
+    y: int
+    z: int
+    mc_item_id: str
+    mc_item_tag: str
+    count: int
+    price_buy: typing.Optional[int]
+    price_sell: typing.Optional[int]
+    payer_acc_id: int
+    main_acc_id: int
+    # валюта счёта владельца коробки, в ней указаны цены
+    currency_id: typing.Optional[int]
+    blocked: bool
+
+
+class BoxIndex:
+    # Все не отключённые коробки в памяти: точный поиск по блоку и сетка чанков
+    # (мир, x >> 4, z >> 4) для запросов по области, а также книги цен по предметам.
+    # Загружается одним запросом, дальше обновляется точечно из PlatfeBothSidedBox.create / disable / block.
+    def __init__(self):
+        self.boxes: typing.Dict[int, BoxRef] = {}
+        self.blocks: typing.Dict[typing.Tuple[int, int, int, int], int] = {}
+        self.chunks: typing.Dict[typing.Tuple[int, int, int], typing.Set[int]] = {}
+        self.prices = PriceIndex()
+        self.loaded = False
+        self.generation = 0
+        self.lock = asyncio.Lock()
+
+    @staticmethod
+    def chunk_of(world_id: int, x: int, z: int) -> typing.Tuple[int, int, int]:
+        return world_id, x >> CHUNK_SHIFT, z >> CHUNK_SHIFT
+
+    def fill(self, boxes: typing.Iterable[BoxRef], generation: int):
+        if generation != self.generation:
+            return False
+        self.boxes = {}
+        self.blocks = {}
+        self.chunks = {}
+        self.prices.clear()
+        for box in boxes:
+            self._put(box)
+        self.loaded = True
+        return True
+
+    def _put(self, box: BoxRef):
+        old = self.boxes.get(box.id)
+        if old is not None:
+            self._remove(old)
+        self.boxes[box.id] = box
+        self.blocks[(box.world_id, box.x, box.y, box.z)] = box.id
+        self.chunks.setdefault(self.chunk_of(box.world_id, box.x, box.z), set()).add(box.id)
+        self.prices.add(box)
+
+    def _remove(self, box: BoxRef):
+        del self.boxes[box.id]
+        self.prices.discard(box)
+        if self.blocks.get((box.world_id, box.x, box.y, box.z)) == box.id:
+            del self.blocks[(box.world_id, box.x, box.y, box.z)]
+        chunk = self.chunk_of(box.world_id, box.x, box.z)
+        ids = self.chunks.get(chunk)
+        if ids is not None:
+            ids.discard(box.id)
+            if not ids:
+                del self.chunks[chunk]
+
+    def changed(self):
+        # незагруженный индекс изменения не касаются; загрузку, идущую прямо сейчас (под lock), они делают устаревшей
+        if self.loaded or self.lock.locked():
+            self.generation += 1
+
+    def put(self, box: BoxRef):
+        self.changed()
+        if self.loaded:
+            self._put(box)
+
+    def update(self, box_id: int, **fields):
+        self.changed()
+        box = self.boxes.get(box_id)
+        if box is not None:
+            self._put(box._replace(**fields))
+
+    def remove(self, box_id: int):
+        self.changed()
+        box = self.boxes.get(box_id)
+        if box is not None:
+            self._remove(box)
+
+    def invalidate(self):
+        self.generation += 1
+        self.loaded = False
+
+    def get(self, box_id: int) -> typing.Optional[BoxRef]:
+        return self.boxes.get(box_id)
+
+    def at(self, world_id: int, x: int, y: int, z: int) -> typing.Optional[BoxRef]:
+        box_id = self.blocks.get((world_id, x, y, z))
+        return self.boxes[box_id] if box_id is not None else None
+
+    def in_area(self, world_id: int, x1: int, z1: int, x2: int, z2: int) -> typing.List[BoxRef]:
+        # прямоугольник в блоках включительно; перебираются только чанки, которые он задевает
+        x1, x2 = min(x1, x2), max(x1, x2)
+        z1, z2 = min(z1, z2), max(z1, z2)
+        r = []
+        for cx in range(x1 >> CHUNK_SHIFT, (x2 >> CHUNK_SHIFT) + 1):
+            for cz in range(z1 >> CHUNK_SHIFT, (z2 >> CHUNK_SHIFT) + 1):
+                for box_id in self.chunks.get((world_id, cx, cz), ()):
+                    box = self.boxes[box_id]
+                    if x1 <= box.x <= x2 and z1 <= box.z <= z2:
+                        r.append(box)
+        r.sort(key=lambda b: b.id)
+        return r
+
+    def best_prices(self, world_id: int, currency_id: int, item: str, side: str, limit: int) -> typing.List[BoxRef]:
+        return [self.boxes[box_id] for box_id in self.prices.best(world_id, currency_id, item, side, limit)]
@@ -0,0 +1,32 @@
+import asyncio
+import contextlib
+import typing
+import weakref
+
+
+class BoxLocks:
+    # Блокировки коробок внутри процесса: сделки с одной коробкой идут по очереди, с разными - параллельно.
+    # Замки берутся в порядке id, поэтому корзины с общими коробками не блокируют друг друга крест-накрест.
+    # Неиспользуемые замки удаляются сами, пока их никто не держит.
+    def __init__(self):
+        self.locks: "weakref.WeakValueDictionary[int, asyncio.Lock]" = weakref.WeakValueDictionary()
+
+    def get(self, box_id: int) -> asyncio.Lock:
+        lock = self.locks.get(box_id)
+        if lock is None:
+            lock = asyncio.Lock()
+            self.locks[box_id] = lock
+        return lock
+
+    @contextlib.asynccontextmanager
+    async def hold(self, box_ids: typing.Iterable[int]):
+        locks = [self.get(box_id) for box_id in sorted(set(box_ids))]
+        acquired = []
+        try:
+            for lock in locks:
+                await lock.acquire()
+                acquired.append(lock)
+            yield
+        finally:
+            for lock in reversed(acquired):
+                lock.release()
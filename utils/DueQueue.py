@@ -0,0 +1,50 @@
+import asyncio
+import datetime as dt
+import heapq
+import typing
+
+
+class DueQueue:
+    # Min-куча (время, вид, id) строк, у которых скоро наступит срок оплаты.
+    # В куче держатся только строки с ближайшими сроками, остальные дозагружаются из базы по индексу.
+    # Устаревшие записи из кучи не удаляются: при извлечении они сверяются с self.due.
+    def __init__(self):
+        self.heap: typing.List[typing.Tuple[dt.datetime, str, int]] = []
+        self.due: typing.Dict[typing.Tuple[str, int], dt.datetime] = {}
+        self.loaded_until: typing.Optional[dt.datetime] = None
+        self.wakeup = asyncio.Event()
+
+    def schedule(self, kind: str, row_id: int, due: typing.Optional[dt.datetime]):
+        if due is None:
+            self.due.pop((kind, row_id), None)
+            return
+        if self.loaded_until is None or due > self.loaded_until:
+            # попадёт в кучу при следующей загрузке
+            self.due.pop((kind, row_id), None)
+            return
+        self.push(kind, row_id, due)
+
+    def push(self, kind: str, row_id: int, due: dt.datetime):
+        if self.due.get((kind, row_id)) == due:
+            return
+        self.due[(kind, row_id)] = due
+        heapq.heappush(self.heap, (due, kind, row_id))
+        if self.heap[0][0] == due:
+            self.wakeup.set()
+
+    def next_due(self) -> typing.Optional[dt.datetime]:
+        while self.heap:
+            due, kind, row_id = self.heap[0]
+            if self.due.get((kind, row_id)) == due:
+                return due
+            heapq.heappop(self.heap)
+        return None
+
+    def pop_due(self, now: dt.datetime) -> typing.Dict[str, typing.List[int]]:
+        r: typing.Dict[str, typing.List[int]] = {}
+        while self.heap and self.heap[0][0] <= now:
+            due, kind, row_id = heapq.heappop(self.heap)
+            if self.due.get((kind, row_id)) == due:
+                del self.due[(kind, row_id)]
+                r.setdefault(kind, []).append(row_id)
+        return r
@@ -0,0 +1,48 @@
+import fnmatch as fn
+import re
+import typing
+
+# сколько результатов проверок запоминать на одного пользователя
+MAX_MEMOIZED_CHECKS = 1024
+
+
+class PermissionMatcher:
+    # Все glob-шаблоны пользователя собраны в одно регулярное выражение.
+    def __init__(self, patterns: typing.Iterable[str]):
+        self.patterns = tuple(patterns)
+        self.regex = re.compile("|".join(fn.translate(p) for p in self.patterns)) if self.patterns else None
+        self.results: typing.Dict[str, bool] = {}
+
+    def check(self, permission_string: str) -> bool:
+        r = self.results.get(permission_string)
+        if r is None:
+            r = self.regex is not None and self.regex.match(permission_string) is not None
+            if len(self.results) < MAX_MEMOIZED_CHECKS:
+                self.results[permission_string] = r
+        return r
+
+    def check_all(self, permission_strings: typing.Iterable[str]) -> typing.List[bool]:
+        return [self.check(p) for p in permission_strings]
+
+
+class PermissionCache:
+    def __init__(self):
+        self.matchers: typing.Dict[int, PermissionMatcher] = {}
+        self.generations: typing.Dict[int, int] = {}
+
+    def get(self, user_id: int) -> typing.Optional[PermissionMatcher]:
+        return self.matchers.get(user_id)
+
+    def generation(self, user_id: int) -> int:
+        return self.generations.get(user_id, 0)
+
+    def put(self, user_id: int, patterns: typing.Iterable[str], generation: int) -> PermissionMatcher:
+        matcher = PermissionMatcher(patterns)
+        # права поменялись, пока шли в базу: такой результат не кэшируем
+        if generation == self.generation(user_id):
+            self.matchers[user_id] = matcher
+        return matcher
+
+    def invalidate(self, user_id: int):
+        self.generations[user_id] = self.generation(user_id) + 1
+        self.matchers.pop(user_id, None)
@@ -0,0 +1,68 @@
+import asyncio
+import typing
+
+
+class PlayerStatusSnapshot:
+    # Снимок "ник -> префиксы" в памяти процесса. Загружается одним запросом,
+    # дальше обновляется точечно из PlatfeNicknameStatus.add_prefix / del_prefix / delete.
+    def __init__(self):
+        self.nicknames: typing.Dict[int, str] = {}
+        self.prefixes: typing.Dict[int, typing.List[typing.Tuple[int, str]]] = {}
+        self.loaded = False
+        self.generation = 0
+        self.lock = asyncio.Lock()
+        self._registry: typing.Optional[typing.Dict[str, str]] = None
+
+    def fill(self, rows: typing.Iterable[typing.Tuple[int, str, int, str]], generation: int):
+        # если во время загрузки пришли изменения, результат уже устарел
+        if generation != self.generation:
+            return False
+
+        self.nicknames = {}
+        self.prefixes = {}
+        for status_id, nickname, prefix_id, serialized in rows:
+            self.nicknames[status_id] = nickname
+            self.prefixes.setdefault(status_id, []).append((prefix_id, serialized))
+        self._registry = None
+        self.loaded = True
+        return True
+
+    def _changed(self):
+        self.generation += 1
+        self._registry = None
+
+    def add_prefix(self, status_id: int, nickname: str, prefix_id: int, serialized: str):
+        self._changed()
+        if not self.loaded:
+            return
+        self.nicknames[status_id] = nickname
+        self.prefixes.setdefault(status_id, []).append((prefix_id, serialized))
+
+    def del_prefix(self, status_id: int, prefix_id: int):
+        self._changed()
+        if not self.loaded:
+            return
+        pp = [p for p in self.prefixes.get(status_id, []) if p[0] != prefix_id]
+        if pp:
+            self.prefixes[status_id] = pp
+        else:
+            self.prefixes.pop(status_id, None)
+
+    def delete(self, status_id: int):
+        self._changed()
+        self.nicknames.pop(status_id, None)
+        self.prefixes.pop(status_id, None)
+
+    def invalidate(self):
+        self._changed()
+        self.loaded = False
+
+    def registry(self) -> typing.Dict[str, str]:
+        if self._registry is None:
+            p = {}
+            for status_id, pp in self.prefixes.items():
+                nickname = self.nicknames[status_id]
+                for i in range(len(pp)):
+                    p[nickname + '_' + str(i)] = pp[i][1]
+            self._registry = p
+        return dict(self._registry)
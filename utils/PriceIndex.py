@@ -0,0 +1,54 @@
+import bisect
+import typing
+
+if typing.TYPE_CHECKING:
+    from utils.BoxIndex import BoxRef
+
+# ключ книги: (мир, валюта, предмет)
+BookKey = typing.Tuple[int, int, str]
+
+
+class PriceIndex:
+    # Книги цен по (мир, валюта, предмет): коробки, отсортированные по цене.
+    # buy - у кого дешевле купить (по возрастанию price_buy, только с товаром в наличии),
+    # sell - кто дороже купит (по убыванию price_sell). Ведётся из BoxIndex.
+    def __init__(self):
+        self.buy: typing.Dict[BookKey, typing.List[typing.Tuple[int, int]]] = {}
+        self.sell: typing.Dict[BookKey, typing.List[typing.Tuple[int, int]]] = {}
+
+    @staticmethod
+    def entries(box: "BoxRef") -> typing.List[typing.Tuple[str, typing.Tuple[int, int]]]:
+        if box.blocked or box.currency_id is None:
+            return []
+        r = []
+        if box.price_buy is not None and box.count > 0:
+            r.append(("buy", (box.price_buy, box.id)))
+        if box.price_sell is not None:
+            r.append(("sell", (-box.price_sell, box.id)))
+        return r
+
+    def add(self, box: "BoxRef"):
+        key = (box.world_id, box.currency_id, box.mc_item_id)
+        for side, entry in self.entries(box):
+            bisect.insort(getattr(self, side).setdefault(key, []), entry)
+
+    def discard(self, box: "BoxRef"):
+        key = (box.world_id, box.currency_id, box.mc_item_id)
+        for side, entry in self.entries(box):
+            books = getattr(self, side)
+            book = books.get(key)
+            if book is None:
+                continue
+            i = bisect.bisect_left(book, entry)
+            if i < len(book) and book[i] == entry:
+                del book[i]
+            if not book:
+                del books[key]
+
+    def clear(self):
+        self.buy = {}
+        self.sell = {}
+
+    def best(self, world_id: int, currency_id: int, item: str, side: str, limit: int) -> typing.List[int]:
+        book = getattr(self, side).get((world_id, currency_id, item), [])
+        return [box_id for _, box_id in book[:limit]]
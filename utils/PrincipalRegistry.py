@@ -0,0 +1,67 @@
+import time
+import typing
+
+# сколько секунд загруженный принципал считается актуальным без уведомлений об изменениях
+PRINCIPAL_TTL = 60
+
+
+class Principal:
+    # Всё, что нужно авторизованным обработчикам о пользователе, без похода в базу.
+    # user - отвязанный от сессии PlatfeUser, годится для передачи в методы таблиц.
+    def __init__(self, user, permissions, account_ids: typing.FrozenSet[int]):
+        self.user = user
+        self.user_id: int = user.id
+        self.disabled: bool = bool(user.disabled)
+        self.permissions = permissions
+        self.account_ids = account_ids
+        self.loaded_at = time.monotonic()
+        self.valid = True
+
+    def is_fresh(self, ttl: float = PRINCIPAL_TTL):
+        return self.valid and time.monotonic() - self.loaded_at < ttl
+
+    def has_permission(self, permission_string: str) -> bool:
+        return self.permissions.check(permission_string)
+
+    def has_permissions(self, permission_strings: typing.Iterable[str]) -> typing.List[bool]:
+        return self.permissions.check_all(permission_strings)
+
+
+class PrincipalRegistry:
+    def __init__(self, ttl: float = PRINCIPAL_TTL):
+        self.ttl = ttl
+        self.principals: typing.Dict[int, Principal] = {}
+        self.generations: typing.Dict[int, int] = {}
+        self.auth_epochs: typing.Dict[int, int] = {}
+
+    def get(self, user_id: int) -> typing.Optional[Principal]:
+        p = self.principals.get(user_id)
+        if p is not None and p.is_fresh(self.ttl):
+            return p
+        return None
+
+    def generation(self, user_id: int) -> int:
+        return self.generations.get(user_id, 0)
+
+    def put(self, principal: Principal, generation: int) -> Principal:
+        if generation == self.generation(principal.user_id):
+            self.principals[principal.user_id] = principal
+        else:
+            # пользователь поменялся, пока шла загрузка
+            principal.valid = False
+        return principal
+
+    def invalidate(self, user_id: int):
+        self.generations[user_id] = self.generation(user_id) + 1
+        p = self.principals.pop(user_id, None)
+        if p is not None:
+            p.valid = False
+
+    def auth_epoch(self, user_id: int) -> int:
+        # соединение запоминает эпоху при логине; если она сменилась, логин больше недействителен
+        return self.auth_epochs.get(user_id, 0)
+
+    def revoke(self, user_id: int):
+        # сброс токена или отключение пользователя: все его сессии недействительны
+        self.auth_epochs[user_id] = self.auth_epoch(user_id) + 1
+        self.invalidate(user_id)
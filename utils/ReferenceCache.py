@@ -0,0 +1,76 @@
+import asyncio
+import time
+import typing
+
+# сколько помнить, что мира с таким именем нет
+MISSING_WORLD_TTL = 30.0
+# сколько отсутствующих имён помнить
+MAX_MISSING_WORLDS = 10000
+
+
+class CurrencyRef(typing.NamedTuple):
+    id: int
+    name: str
+    short_name: str
+
+
+class WorldRef(typing.NamedTuple):
+    id: int
+    server_name: str
+    ip: str
+    world: str
+
+
+class ReferenceCache:
+    # Валюты и миры целиком в памяти процесса: таблицы маленькие и почти не меняются.
+    # Загружаются одним проходом, после записи в таблицы сбрасываются и перечитываются при следующем обращении.
+    def __init__(self):
+        self.currencies: typing.Dict[int, CurrencyRef] = {}
+        self.worlds: typing.Dict[str, WorldRef] = {}
+        # имя мира -> до какого момента (time.monotonic) считать, что его нет в базе
+        self.missing_worlds: typing.Dict[str, float] = {}
+        self.loaded = False
+        self.generation = 0
+        self.lock = asyncio.Lock()
+
+    def fill(self, currencies: typing.Iterable[CurrencyRef], worlds: typing.Iterable[WorldRef], generation: int):
+        if generation != self.generation:
+            return False
+        self.currencies = {c.id: c for c in currencies}
+        self.worlds = {w.world: w for w in worlds}
+        self.loaded = True
+        return True
+
+    def invalidate(self):
+        self.generation += 1
+        self.loaded = False
+        self.missing_worlds = {}
+
+    def currency(self, cur_id: int) -> typing.Optional[CurrencyRef]:
+        return self.currencies.get(cur_id)
+
+    def currency_by_short_name(self, short_name: str) -> typing.Optional[CurrencyRef]:
+        for c in self.currencies.values():
+            if c.short_name == short_name:
+                return c
+        return None
+
+    def world(self, world: str) -> typing.Optional[WorldRef]:
+        return self.worlds.get(world)
+
+    def is_missing_world(self, world: str) -> bool:
+        until = self.missing_worlds.get(world)
+        if until is None:
+            return False
+        if until < time.monotonic():
+            del self.missing_worlds[world]
+            return False
+        return True
+
+    def miss_world(self, world: str):
+        if len(self.missing_worlds) >= MAX_MISSING_WORLDS:
+            self.missing_worlds = {}
+        self.missing_worlds[world] = time.monotonic() + MISSING_WORLD_TTL
+
+    def all_currencies(self) -> typing.List[CurrencyRef]:
+        return list(self.currencies.values())
@@ -0,0 +1,67 @@
+import collections
+import typing
+
+
+def parse_version(version) -> typing.Optional[typing.Tuple[str, int]]:
+    # версия реестра имеет вид "<эпоха>.<номер>", номер растёт внутри эпохи
+    if not isinstance(version, str):
+        return None
+    epoch, _, n = version.rpartition(".")
+    if not epoch or not n.isdigit():
+        return None
+    return epoch, int(n)
+
+
+class RegistryChangeLog:
+    # Хранит последний отданный снимок реестра и ограниченный журнал изменений между версиями,
+    # чтобы клиенту с известной версией можно было отправить только разницу.
+    def __init__(self, limit: int = 64):
+        self.version: typing.Optional[str] = None
+        self.snapshot: typing.Dict[str, str] = {}
+        self.changes: typing.Deque[typing.Tuple[str, str, typing.Dict[str, str], typing.List[str]]] = \
+            collections.deque(maxlen=limit)
+
+    def observe(self, version: str, registry: typing.Dict[str, str]) -> typing.Dict[str, str]:
+        if version == self.version:
+            return self.snapshot
+
+        new = parse_version(version)
+        old = parse_version(self.version)
+        if new is not None and old is not None and new[0] == old[0]:
+            if new[1] < old[1]:
+                # пока собирался реестр, вышла более новая версия
+                return registry
+            changed = {k: v for k, v in registry.items() if self.snapshot.get(k) != v}
+            removed = [k for k in self.snapshot if k not in registry]
+            self.changes.append((self.version, version, changed, removed))
+        else:
+            self.changes.clear()
+
+        self.version = version
+        self.snapshot = dict(registry)
+        return self.snapshot
+
+    def since(self, version: str) -> typing.Optional[dict]:
+        start = None
+        for i, (from_version, _, _, _) in enumerate(self.changes):
+            if from_version == version:
+                start = i
+                break
+        if start is None:
+            return None
+
+        changed: typing.Dict[str, str] = {}
+        removed: typing.Set[str] = set()
+        for i in range(start, len(self.changes)):
+            _, _, ch, rm = self.changes[i]
+            for k in rm:
+                changed.pop(k, None)
+                removed.add(k)
+            for k, v in ch.items():
+                removed.discard(k)
+                changed[k] = v
+
+        p: typing.Dict[str, typing.Any] = dict(changed)
+        p["$from"] = version
+        p["$removed"] = sorted(removed)
+        return p
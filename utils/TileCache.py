@@ -0,0 +1,77 @@
+import collections
+import typing
+
+# сколько байт тайлов держать в памяти
+MAX_TILE_CACHE_BYTES = 64 * 1024 * 1024
+# примерная цена записи помимо самих строк: ключ, кортеж, узел OrderedDict
+TILE_ENTRY_OVERHEAD = 200
+
+TileKey = typing.Tuple[int, int, int]
+# (tile_hash, tile); None - тайла в базе нет
+TileEntry = typing.Optional[typing.Tuple[str, str]]
+
+
+class TileCache:
+    # LRU тайлов карты (мир, chunk_x, chunk_y) для HTTP, ограниченный по объёму.
+    # Отсутствующие тайлы тоже запоминаются: большая часть публичной карты не исследована.
+    # Загрузка тайлов обновляет только уже лежащие в кэше записи, чтобы выгрузка карты не вытесняла просматриваемое.
+    # Чтение из базы оборачивается в begin / end: если тайл обновили, пока его читали, прочитанное не сохраняется.
+    def __init__(self, max_bytes: int = MAX_TILE_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.tiles: "collections.OrderedDict[TileKey, TileEntry]" = collections.OrderedDict()
+        self.loading: typing.Dict[TileKey, int] = {}
+        self.generation = 0
+
+    @staticmethod
+    def weight(entry: TileEntry) -> int:
+        if entry is None:
+            return TILE_ENTRY_OVERHEAD
+        return TILE_ENTRY_OVERHEAD + len(entry[0]) + len(entry[1])
+
+    def get(self, key: TileKey) -> typing.Tuple[bool, TileEntry]:
+        if key not in self.tiles:
+            return False, None
+        self.tiles.move_to_end(key)
+        return True, self.tiles[key]
+
+    def begin(self, keys: typing.Iterable[TileKey]) -> int:
+        for key in keys:
+            self.loading[key] = self.loading.get(key, 0) + 1
+        return self.generation
+
+    def fill(self, entries: typing.Dict[TileKey, TileEntry], generation: int):
+        if generation != self.generation:
+            return False
+        for key, entry in entries.items():
+            self._set(key, entry)
+        return True
+
+    def end(self, keys: typing.Iterable[TileKey]):
+        for key in keys:
+            n = self.loading.get(key, 0) - 1
+            if n > 0:
+                self.loading[key] = n
+            else:
+                self.loading.pop(key, None)
+
+    def refresh(self, key: TileKey, entry: TileEntry):
+        if key in self.loading:
+            self.generation += 1
+        if key in self.tiles:
+            self._set(key, entry)
+
+    def _set(self, key: TileKey, entry: TileEntry):
+        if key in self.tiles:
+            self.size -= self.weight(self.tiles[key])
+        self.tiles[key] = entry
+        self.tiles.move_to_end(key)
+        self.size += self.weight(entry)
+        while self.size > self.max_bytes and self.tiles:
+            _, old = self.tiles.popitem(last=False)
+            self.size -= self.weight(old)
+
+    def clear(self):
+        self.generation += 1
+        self.tiles.clear()
+        self.size = 0
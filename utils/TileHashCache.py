@@ -0,0 +1,31 @@
+import collections
+import typing
+
+# сколько тайлов помнить; запись ~100 байт, итого порядка десятков мегабайт
+MAX_TILE_HASHES = 200000
+
+TileKey = typing.Tuple[int, int, int]
+
+
+class TileHashCache:
+    # (мир, chunk_x, chunk_y) -> (id строки PlatfeMap, tile_hash) для недавно загруженных тайлов.
+    # Повторная выгрузка неизменившегося тайла узнаётся по хэшу без обращения к базе.
+    # Вытесняются давно не встречавшиеся тайлы.
+    def __init__(self, max_size: int = MAX_TILE_HASHES):
+        self.max_size = max_size
+        self.tiles: "collections.OrderedDict[TileKey, typing.Tuple[int, str]]" = collections.OrderedDict()
+
+    def get(self, key: TileKey) -> typing.Optional[typing.Tuple[int, str]]:
+        r = self.tiles.get(key)
+        if r is not None:
+            self.tiles.move_to_end(key)
+        return r
+
+    def put(self, key: TileKey, tile_id: int, tile_hash: str):
+        self.tiles[key] = (tile_id, tile_hash)
+        self.tiles.move_to_end(key)
+        while len(self.tiles) > self.max_size:
+            self.tiles.popitem(last=False)
+
+    def clear(self):
+        self.tiles.clear()
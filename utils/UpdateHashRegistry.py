@@ -1,44 +1,129 @@
+import asyncio
 import os
 import json
+import threading
+import typing
+
 from passlib import pwd
 
+from utils.RegistryChangeLog import parse_version
+
+# через сколько секунд после изменения состояние сбрасывается на диск
+FLUSH_DELAY = 0.5
+# на сколько версий сдвигаемся после перезапуска: изменения за последние FLUSH_DELAY секунд
+# могли не дойти до диска, а уже выданные клиентам версии не должны повториться
+RESTART_GAP = 1024
+
 
 class UpdateHashRegistry:
     def __init__(self, filename: str):
         self.filename = filename
         self.path = "tmp/" + self.filename
+        self.data: typing.Optional[typing.Dict[str, str]] = None
+        self.persisted: typing.Dict[str, int] = {}
+        self.dirty = False
+        self.flush_task: typing.Optional[asyncio.Task] = None
+        self.flush_lock = asyncio.Lock()
 
     def create_files(self):
-
         if not os.path.exists("tmp/"):
             os.mkdir("tmp/")
 
-        if not os.path.exists(self.path):
-            with open(self.path, "w") as fp:
-                fp.write("{}")
+    def load(self):
+        if self.data is not None:
+            return self.data
 
-    def update(self, key: str, value: str):
-        self.create_files()
         data = {}
-        with open(self.path) as fp:
-            data = json.load(fp)
+        if os.path.exists(self.path):
+            try:
+                with open(self.path) as fp:
+                    data = json.load(fp)
+            except ValueError as e:
+                print(str(e))
+
+        self.data = {}
+        for key, value in data.items():
+            v = parse_version(value)
+            if v is not None:
+                self.data[key] = v[0] + "." + str(v[1] + RESTART_GAP)
+        if self.data:
+            self.write_now()
+        return self.data
 
-        data[key] = value
-        with open(self.path, "w") as fp:
-            json.dump(data, fp)
+    def update(self, key: str, value: str):
+        self.load()[key] = value
+        self.schedule_flush()
 
     def get(self, key: str):
-        self.create_files()
-        data = {}
-        with open(self.path) as fp:
-            data = json.load(fp)
+        data = self.load()
         if data.get(key) is None:
-            return self.change_to_random(key)
+            return self.bump(key)
         else:
             return data[key]
 
-    def change_to_random(self, key: str):
-        p = pwd.genword(length=12)
+    def bump(self, key: str):
+        # версия вида "<эпоха>.<номер>": номер монотонно растёт,
+        # а новая эпоха появляется только если файл с версиями потерялся
+        v = parse_version(self.load().get(key))
+        if v is None:
+            p = pwd.genword(length=12) + ".1"
+        else:
+            p = v[0] + "." + str(v[1] + 1)
         self.update(key, p)
+
+        if v is not None and v[1] + 1 - self.persisted.get(key, 0) >= RESTART_GAP:
+            # запас версий исчерпан раньше, чем успели записать файл
+            self.write_now()
         return p
 
+    def schedule_flush(self):
+        self.dirty = True
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.write_now()
+            return
+
+        if self.flush_task is None or self.flush_task.done():
+            self.flush_task = loop.create_task(self.flush_later())
+
+    async def flush_later(self):
+        # все изменения за FLUSH_DELAY попадают в одну запись с одним fsync
+        while self.dirty:
+            await asyncio.sleep(FLUSH_DELAY)
+            await self.flush()
+
+    async def flush(self):
+        async with self.flush_lock:
+            if not self.dirty:
+                return
+            self.dirty = False
+            data = dict(self.data)
+            try:
+                await asyncio.to_thread(self.write, json.dumps(data))
+            except OSError as e:
+                self.dirty = True
+                print(str(e))
+                return
+            self.mark_persisted(data)
+
+    def write_now(self):
+        data = dict(self.data)
+        self.write(json.dumps(data))
+        self.dirty = False
+        self.mark_persisted(data)
+
+    def mark_persisted(self, data: typing.Dict[str, str]):
+        for key, value in data.items():
+            v = parse_version(value)
+            if v is not None:
+                self.persisted[key] = v[1]
+
+    def write(self, payload: str):
+        self.create_files()
+        tmp_path = "%s.%d.tmp" % (self.path, threading.get_ident())
+        with open(tmp_path, "w") as fp:
+            fp.write(payload)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(tmp_path, self.path)
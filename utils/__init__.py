@@ -1,5 +1,31 @@
+from utils.AuthCache import AuthCache
+from utils.BoxIndex import BoxIndex
+from utils.BoxLocks import BoxLocks
+from utils.DueQueue import DueQueue
+from utils.PermissionCache import PermissionCache
+from utils.PlayerStatusSnapshot import PlayerStatusSnapshot
+from utils.PrincipalRegistry import PrincipalRegistry
+from utils.ReferenceCache import ReferenceCache
+from utils.RegistryChangeLog import RegistryChangeLog
+from utils.TileCache import TileCache
+from utils.TileHashCache import TileHashCache
 from utils.UpdateHashRegistry import UpdateHashRegistry
 
 registry_statuses = UpdateHashRegistry("player_statuses_registry.json")
 registry_prefixes = UpdateHashRegistry("prefix_registry.json")
 registry_accounts = UpdateHashRegistry("accounts_registry.json")
+
+changes_statuses = RegistryChangeLog()
+changes_prefixes = RegistryChangeLog()
+changes_accounts = RegistryChangeLog()
+
+status_snapshot = PlayerStatusSnapshot()
+permission_cache = PermissionCache()
+principals = PrincipalRegistry()
+auth_cache = AuthCache()
+due_queue = DueQueue()
+references = ReferenceCache()
+box_index = BoxIndex()
+box_locks = BoxLocks()
+tile_hashes = TileHashCache()
+tile_cache = TileCache()
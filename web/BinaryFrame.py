@@ -0,0 +1,25 @@
+import typing
+
+# Двоичный кадр: [длина id: 1 байт][id в utf-8][данные обработчика]
+MAX_FRAME_ID_LENGTH = 255
+
+
+def encode_frame(frame_id: str, payload: bytes) -> bytes:
+    raw_id = frame_id.encode("utf-8")
+    if len(raw_id) > MAX_FRAME_ID_LENGTH:
+        raise ValueError("Frame id too long: %s" % frame_id)
+    return bytes([len(raw_id)]) + raw_id + payload
+
+
+def decode_frame(data: bytes) -> typing.Optional[typing.Tuple[str, memoryview]]:
+    # данные отдаются без копирования; None - кадр повреждён
+    if not data:
+        return None
+    end = 1 + data[0]
+    if len(data) < end:
+        return None
+    try:
+        frame_id = bytes(data[1:end]).decode("utf-8")
+    except UnicodeDecodeError:
+        return None
+    return frame_id, memoryview(data)[end:]
@@ -0,0 +1,89 @@
+import asyncio
+import collections
+import logging
+import typing
+
+from handlers.AbstractHandler import AbstractHandler
+from web.PlatfeNotifier import PlatfeNotifier
+
+if typing.TYPE_CHECKING:
+    from web.app import PlatfeConnection
+
+# сколько сообщений соединения может ждать свободного слота; сверх этого сообщения отклоняются
+MAX_PENDING = 256
+
+log = logging.getLogger(__name__)
+
+
+class ConnectionDispatcher:
+    # Чтение сокета никогда не ждёт обработчиков: immediate-сообщения выполняются сразу,
+    # остальные встают в ограниченную очередь, которую по порядку разбирает отдельная задача,
+    # запуская не больше max_in_flight обработчиков одновременно.
+    def __init__(self, c: "PlatfeConnection", max_in_flight: int, max_pending: int = MAX_PENDING):
+        self.c = c
+        self.slots = asyncio.Semaphore(max_in_flight)
+        self.tasks: typing.Set[asyncio.Task] = set()
+        self.max_pending = max_pending
+        self.pending: typing.Deque[typing.Tuple[AbstractHandler, dict]] = collections.deque()
+        self.worker: typing.Optional[asyncio.Task] = None
+
+    async def dispatch(self, handler: AbstractHandler, jsn: dict):
+        if handler.immediate:
+            await self.run(handler, jsn)
+            return
+
+        if len(self.pending) >= self.max_pending:
+            log.warning("connection %s: %d messages pending, %s rejected", self.c.user_id, len(self.pending), handler.get_id())
+            await self.reject(handler, jsn)
+            return
+
+        self.pending.append((handler, jsn))
+        if self.worker is None or self.worker.done():
+            self.worker = asyncio.create_task(self.work())
+
+    async def reject(self, handler: AbstractHandler, jsn: dict):
+        # клиент не должен ждать ответа на отброшенное сообщение; у двоичных кадров нет $destination,
+        # они отвечают в канал с id обработчика
+        data = jsn.get("data")
+        destination = data.get("$destination") if isinstance(data, dict) else None
+        if not isinstance(destination, str) or not destination:
+            destination = handler.get_id()
+        await PlatfeNotifier.send(self.c, destination, {"message": "Server busy, request rejected.", "status": "busy"})
+
+    async def work(self):
+        while self.pending:
+            handler, jsn = self.pending.popleft()
+
+            if handler.sequential:
+                # всё, что пришло раньше, должно завершиться до этого сообщения,
+                # а всё, что придёт позже, начнётся только после него
+                await self.drain_tasks()
+                await self.run(handler, jsn)
+                continue
+
+            await self.slots.acquire()
+            task = asyncio.create_task(self._run_in_slot(handler, jsn))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def run(self, handler: AbstractHandler, jsn: dict):
+        try:
+            await handler.handle(self.c, jsn)
+        except Exception as e:
+            print("handler %s failed: %s" % (handler.get_id(), str(e)))
+
+    async def _run_in_slot(self, handler: AbstractHandler, jsn: dict):
+        try:
+            await self.run(handler, jsn)
+        finally:
+            self.slots.release()
+
+    async def drain_tasks(self):
+        if self.tasks:
+            await asyncio.gather(*list(self.tasks))
+
+    async def drain(self):
+        # очередь и всё, что уже выполняется
+        if self.worker is not None:
+            await self.worker
+        await self.drain_tasks()
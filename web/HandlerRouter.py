@@ -0,0 +1,43 @@
+import inspect
+import types
+import typing
+
+from handlers.AbstractHandler import AbstractHandler
+
+
+class HandlerRouter:
+    def __init__(self):
+        self.handlers: typing.Dict[str, AbstractHandler] = {}
+
+    def register(self, handler: AbstractHandler):
+        handler_id = handler.get_id()
+        if handler_id in self.handlers:
+            raise ValueError(
+                "Duplicate handler id '%s': %s and %s" %
+                (handler_id, type(self.handlers[handler_id]).__name__, type(handler).__name__)
+            )
+        # схема компилируется один раз при регистрации, а не на каждое сообщение
+        handler.compile_schema()
+        self.handlers[handler_id] = handler
+        return handler
+
+    def register_all(self, handlers: typing.Iterable[AbstractHandler]):
+        for handler in handlers:
+            self.register(handler)
+
+    def register_module(self, module: types.ModuleType):
+        # регистрирует все обработчики, объявленные в модуле
+        for _, cls in inspect.getmembers(module, inspect.isclass):
+            if cls.__module__ == module.__name__ and issubclass(cls, AbstractHandler) and cls is not AbstractHandler:
+                self.register(cls())
+
+    def get(self, handler_id) -> typing.Optional[AbstractHandler]:
+        if not isinstance(handler_id, str):
+            return None
+        return self.handlers.get(handler_id)
+
+    def __contains__(self, handler_id):
+        return handler_id in self.handlers
+
+    def __len__(self):
+        return len(self.handlers)
@@ -0,0 +1,72 @@
+import asyncio
+import typing
+
+from web.connections import connections
+
+if typing.TYPE_CHECKING:
+    from web.app import PlatfeConnection
+
+
+class Heartbeat:
+    # Соединения разложены по слотам колеса; за один интервал колесо делает полный оборот,
+    # так что пинги равномерно распределены по интервалу, а не уходят одной пачкой.
+    def __init__(self, interval: float, slots: int = 20, send_timeout: float = 5):
+        self.interval = interval
+        self.send_timeout = send_timeout
+        self.slots: typing.List[typing.Set["PlatfeConnection"]] = [set() for _ in range(slots)]
+        self.slot_of: typing.Dict["PlatfeConnection", int] = {}
+        self.next_slot = 0
+        self.tasks: typing.Set[asyncio.Task] = set()
+
+    def schedule(self, c: "PlatfeConnection"):
+        if c in self.slot_of:
+            return
+        slot = self.next_slot
+        self.next_slot = (self.next_slot + 1) % len(self.slots)
+        self.slots[slot].add(c)
+        self.slot_of[c] = slot
+
+    def unschedule(self, c: "PlatfeConnection"):
+        slot = self.slot_of.pop(c, None)
+        if slot is not None:
+            self.slots[slot].discard(c)
+
+    async def reap(self, c: "PlatfeConnection"):
+        self.unschedule(c)
+        connections.discard(c)
+        try:
+            await asyncio.wait_for(c.ws.close(), self.send_timeout)
+        except Exception as e:
+            print(str(e))
+
+    async def beat(self, c: "PlatfeConnection"):
+        if c.ws.closed or c.mark:
+            # сокет закрыт или на прошлый ping так и не пришёл pong
+            await self.reap(c)
+            return
+
+        try:
+            await asyncio.wait_for(c.ping(), self.send_timeout)
+        except Exception as e:
+            print(str(e))
+            await self.reap(c)
+
+    async def beat_slot(self, slot: int):
+        bucket = list(self.slots[slot])
+        if bucket:
+            await asyncio.gather(*[self.beat(c) for c in bucket])
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        tick = self.interval / len(self.slots)
+        slot = 0
+        next_tick = loop.time()
+        while 1:
+            # слот отрабатывает в отдельной задаче, чтобы медленные сокеты не сдвигали расписание
+            task = asyncio.create_task(self.beat_slot(slot))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+            slot = (slot + 1) % len(self.slots)
+            next_tick += tick
+            await asyncio.sleep(max(0.0, next_tick - loop.time()))
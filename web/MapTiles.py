@@ -0,0 +1,104 @@
+import hashlib
+import typing
+
+from aiohttp import web
+
+from db.db import session_maker
+from db.tables import PlatfeMap, PlatfeWorlds, MAP_WRITE_CHUNK
+from handlers.MapUploadHandler import TILE_HEADER
+
+# наибольшее число чанков в прямоугольнике одной пачки
+MAX_BUNDLE_TILES = 64 * 64
+# браузер и прокси хранят ответ, но каждый раз сверяют ETag
+CACHE_CONTROL = "public, no-cache"
+
+
+def not_modified(request: web.Request, etag: str) -> bool:
+    header = request.headers.get("If-None-Match")
+    if header is None:
+        return False
+    # If-None-Match сравнивается слабо: W/"x" совпадает с "x"
+    tags = [t.strip() for t in header.split(",")]
+    return "*" in tags or etag in [t[2:] if t.startswith("W/") else t for t in tags]
+
+
+class MapTiles:
+    # HTTP-доступ к тайлам PlatfeMap для публичной карты.
+    # /map/{world}/{x}/{y} - один тайл, ETag = tile_hash;
+    # /map/{world}/bundle?x1=&y1=&x2=&y2= - все существующие тайлы прямоугольника записями
+    # [chunk_x: int32 BE][chunk_y: int32 BE][тайл], как при выгрузке; ETag считается по хэшам тайлов пачки.
+
+    @staticmethod
+    def routes() -> typing.List[web.RouteDef]:
+        return [
+            web.get("/map/{world}/bundle", MapTiles.bundle),
+            web.get("/map/{world}/{x}/{y}", MapTiles.tile)
+        ]
+
+    @staticmethod
+    async def tile(request: web.Request) -> web.StreamResponse:
+        try:
+            key = (int(request.match_info["x"]), int(request.match_info["y"]))
+        except ValueError:
+            raise web.HTTPBadRequest()
+
+        async with session_maker() as session:
+            world = await PlatfeWorlds.get_world_ref(session, request.match_info["world"])
+            if world is None:
+                raise web.HTTPNotFound()
+            # тайл читается в новой транзакции, чтобы прочитанное можно было положить в кэш
+            await session.rollback()
+            entry = (await PlatfeMap.get_cached_tiles(session, world.id, [key]))[key]
+
+        if entry is None:
+            raise web.HTTPNotFound()
+        tile_hash, tile = entry
+        headers = {"ETag": '"' + tile_hash + '"', "Cache-Control": CACHE_CONTROL}
+        if not_modified(request, headers["ETag"]):
+            return web.Response(status=304, headers=headers)
+        return web.Response(body=tile.encode("ascii"), content_type="application/octet-stream", headers=headers)
+
+    @staticmethod
+    async def bundle(request: web.Request) -> web.StreamResponse:
+        try:
+            x1, y1, x2, y2 = [int(request.query[k]) for k in ("x1", "y1", "x2", "y2")]
+        except (KeyError, ValueError):
+            raise web.HTTPBadRequest()
+        x1, x2 = min(x1, x2), max(x1, x2)
+        y1, y2 = min(y1, y2), max(y1, y2)
+        if (x2 - x1 + 1) * (y2 - y1 + 1) > MAX_BUNDLE_TILES:
+            raise web.HTTPBadRequest(text="Area too large.")
+
+        async with session_maker() as session:
+            world = await PlatfeWorlds.get_world_ref(session, request.match_info["world"])
+            if world is None:
+                raise web.HTTPNotFound()
+
+            # хэши и содержимое читаются в одной транзакции, поэтому ETag соответствует отданным тайлам
+            hashes = await PlatfeMap.get_hashes_in_range(session, world.id, x1, y1, x2, y2)
+            digest = hashlib.md5()
+            for chunk_x, chunk_y, tile_hash in hashes:
+                digest.update(TILE_HEADER.pack(chunk_x, chunk_y) + tile_hash.encode("ascii"))
+            headers = {"ETag": '"' + digest.hexdigest() + '"', "Cache-Control": CACHE_CONTROL}
+            if not_modified(request, headers["ETag"]):
+                return web.Response(status=304, headers=headers)
+
+            # пачка (до MAX_BUNDLE_TILES тайлов) собирается целиком до отправки,
+            # чтобы медленный клиент не держал соединение с базой, пока читает ответ;
+            # тайлы читаются в транзакции хэшей, поэтому в кэш они не кладутся (см. get_cached_tiles)
+            parts = []
+            for i in range(0, len(hashes), MAP_WRITE_CHUNK):
+                expected = {(chunk_x, chunk_y): tile_hash for chunk_x, chunk_y, tile_hash in hashes[i:i + MAP_WRITE_CHUNK]}
+                tiles = await PlatfeMap.get_cached_tiles(session, world.id, expected.keys(), expected)
+                parts.append(b"".join(
+                    TILE_HEADER.pack(*key) + tiles[key][1].encode("ascii")
+                    for key in expected if tiles.get(key) is not None
+                ))
+
+        response = web.StreamResponse(headers=headers)
+        response.content_type = "application/octet-stream"
+        await response.prepare(request)
+        for part in parts:
+            await response.write(part)
+        await response.write_eof()
+        return response
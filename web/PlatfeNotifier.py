@@ -1,6 +1,8 @@
 import asyncio
+import json
 import typing
 
+import aiohttp
 from discord import User
 
 from db.tables import PlatfeUser
@@ -15,21 +17,21 @@ class PlatfeNotifier:
 
     @staticmethod
     async def send_to_users(usr: typing.List[PlatfeUser], destination, data):
-        ids = [u.id for u in usr]
-        disids = [u.disid for u in usr]
-        # Возможно стоит убрать дубликаты в ids и disids.
         cors = []
-        c: PlatfeConnection
-        for c in connections:
-            if c.user_id in ids:
-                cors.append(PlatfeNotifier.send(c, destination, data))
-                ids.remove(c.user_id)
-                disids.remove(c.didid)
+        seen = set()
+        for u in usr:
+            if u.id in seen:
+                continue
+            seen.add(u.id)
 
-        for d in disids:
-            cors.append(PlatfeNotifier.send_to_discord(d, destination, data))
+            cors.append(PlatfeNotifier.send_to_discord(u.disid, destination, data))
+            c: PlatfeConnection
+            for c in connections.by_user(u.id):
+                cors.append(PlatfeNotifier.send_to_connection(c, destination, data))
 
-        await asyncio.gather(*cors)
+        for r in await asyncio.gather(*cors, return_exceptions=True):
+            if isinstance(r, Exception):
+                print(r)
 
     @staticmethod
     async def send(c: "PlatfeConnection", destination, data):
@@ -65,3 +67,20 @@ class PlatfeNotifier:
     @staticmethod
     async def send_all(destination, data):
         await asyncio.gather(*[PlatfeNotifier.send(c, destination, data) for c in connections])
+
+    @staticmethod
+    async def broadcast(destination, data):
+        # кадр кодируется один раз, всем авторизованным соединениям уходят одни и те же байты
+        frame = json.dumps({
+            "id": destination,
+            "timestamp": 0,
+            "data": data
+        }).encode("utf-8")
+        await asyncio.gather(*[PlatfeNotifier.send_frame(c, frame) for c in connections.authed()])
+
+    @staticmethod
+    async def send_frame(c: "PlatfeConnection", frame: bytes):
+        try:
+            await c.ws.send_frame(frame, aiohttp.WSMsgType.TEXT)
+        except Exception as e:
+            print(str(e))
@@ -1,18 +1,25 @@
-import asyncio
 import json
+import time
 import typing
 
 import aiohttp
 from aiohttp import web
 from datetime import datetime
 
-from handlers.AbstractHandler import AbstractHandler
 from handlers import PongHandler, LoginHandler, CreatePrefixHandler, RegistryPrefixesUpdateHandler, \
     GetAllCurrenciesHandler, GetMyAccountsHandler, PayHandler, GetPermissionHandler, RegistryPlayerStatusesHandler, \
-    AddPrefixToPlayerHandler, ClearAllPrefixesHandler, RegistryAccounts
+    AddPrefixToPlayerHandler, ClearAllPrefixesHandler, RegistryAccounts, BoxRegisterHandler, PermissionCommandHandler, \
+    PayBatchHandler, BoxesInAreaHandler, BestPricesHandler, TradeHandler, MapUploadHandler
+from utils.PrincipalRegistry import Principal
+from web.BinaryFrame import decode_frame
+from web.ConnectionDispatcher import ConnectionDispatcher
+from web.HandlerRouter import HandlerRouter
+from web.MapTiles import MapTiles
+from web.Heartbeat import Heartbeat
 from web.connections import connections
 
-registered_handlers: typing.List[AbstractHandler] = [
+router = HandlerRouter()
+router.register_all([
     PongHandler.PongHandler(),
     LoginHandler.LoginHandler(),
     CreatePrefixHandler.CreatePrefixHandler(),
@@ -24,52 +31,70 @@ registered_handlers: typing.List[AbstractHandler] = [
     GetAllCurrenciesHandler.GetAllCurrenciesHandler(),
     GetMyAccountsHandler.GetMyAccountsHandler(),
     PayHandler.PayHandler(),
+    PayBatchHandler.PayBatchHandler(),
+    BoxesInAreaHandler.BoxesInAreaHandler(),
+    BestPricesHandler.BestPricesHandler(),
+    TradeHandler.TradeHandler(),
+    MapUploadHandler.MapUploadHandler(),
     GetPermissionHandler.GetPermissionHandler()
-]
+])
+router.register_module(BoxRegisterHandler)
+router.register_module(PermissionCommandHandler)
 
 
 CHECK_TIME = 20
+# сколько сообщений одного соединения может обрабатываться одновременно
+MAX_IN_FLIGHT = 16
 
 
 class PlatfeConnection:
     ws: web.WebSocketResponse
     last_check_time: datetime
+    ping_sent: typing.Optional[float]
+    rtt: typing.Optional[float]
     mark: bool
     authed: bool
     user_id: typing.Optional[int]
     didid: typing.Optional[int]
+    principal: typing.Optional[Principal]
+    auth_epoch: int
 
     def __init__(self, ws: web.WebSocketResponse):
         self.ws = ws
         self.last_check_time = datetime.now()
+        self.ping_sent = None
+        self.rtt = None
         self.mark = False
         self.authed = False
         self.user_id = None
         self.didid = None
+        self.principal = None
+        self.auth_epoch = 0
 
-    async def check_active(self):
-        if self.mark:
-            await self.ws.close()
-        else:
-            await self.ws.send_json({
-                "id": "ping",
-                "data": {},
-                "timestamp": 0
-            })
-
-            self.last_check_time = datetime.now()
-            self.mark = True
+    async def ping(self):
+        self.last_check_time = datetime.now()
+        self.ping_sent = time.monotonic()
+        self.mark = True
+        await self.ws.send_json({
+            "id": "ping",
+            "data": {},
+            "timestamp": 0
+        })
+
+    def pong(self):
+        if self.mark and self.ping_sent is not None:
+            self.rtt = time.monotonic() - self.ping_sent
+        self.refresh()
 
     def refresh(self):
         self.mark = False
 
 
-async def checker():
-    while 1:
-        for i in range(len(connections)):
-            await connections[i].check_active()
+heartbeat = Heartbeat(CHECK_TIME)
 
-        await asyncio.sleep(CHECK_TIME)
+
+async def checker():
+    await heartbeat.run()
 
 
 async def websocket_handler(request):
@@ -78,25 +103,39 @@ async def websocket_handler(request):
         await ws.prepare(request)
 
         c = PlatfeConnection(ws)
-        connections.append(c)
-
-        async for msg in ws:
-            if msg.type == aiohttp.WSMsgType.TEXT:
-                jsn = json.loads(msg.data)
-                if jsn.get("id") is None:
-                    continue
-
-                for handler in registered_handlers:
-                    if jsn["id"] == handler.get_id():
-                        await handler.handle(c, jsn)
-
-            elif msg.type == aiohttp.WSMsgType.ERROR:
-                print('ws connection closed with exception %s' %
-                      ws.exception())
+        connections.add(c)
+        heartbeat.schedule(c)
+        dispatcher = ConnectionDispatcher(c, MAX_IN_FLIGHT)
+
+        try:
+            async for msg in ws:
+                if msg.type == aiohttp.WSMsgType.TEXT:
+                    jsn = json.loads(msg.data)
+                    if jsn.get("id") is None:
+                        continue
+
+                    handler = router.get(jsn["id"])
+                    if handler is not None:
+                        await dispatcher.dispatch(handler, jsn)
+
+                elif msg.type == aiohttp.WSMsgType.BINARY:
+                    frame = decode_frame(msg.data)
+                    if frame is None:
+                        continue
+
+                    handler = router.get(frame[0])
+                    if handler is not None and handler.binary:
+                        await dispatcher.dispatch(handler, {"id": frame[0], "data": frame[1]})
+
+                elif msg.type == aiohttp.WSMsgType.ERROR:
+                    print('ws connection closed with exception %s' %
+                          ws.exception())
+        finally:
+            heartbeat.unschedule(c)
+            connections.discard(c)
+            await dispatcher.drain()
 
         print('websocket connection closed')
-        connections.remove(c)
-
         return ws
     except Exception as e:
         print(str(e))
@@ -105,6 +144,7 @@ async def websocket_handler(request):
 def init_func():
     app = web.Application()
     app.add_routes([web.get('/ws', websocket_handler)])
+    app.add_routes(MapTiles.routes())
     return app
 
 
@@ -1,2 +1,71 @@
+import typing
 
-connections = []
\ No newline at end of file
+if typing.TYPE_CHECKING:
+    from web.app import PlatfeConnection
+
+
+class ConnectionHub:
+    def __init__(self):
+        self._connections: typing.Set["PlatfeConnection"] = set()
+        self._by_user: typing.Dict[int, typing.Set["PlatfeConnection"]] = {}
+        self._by_didid: typing.Dict[int, typing.Set["PlatfeConnection"]] = {}
+
+    def add(self, c: "PlatfeConnection"):
+        self._connections.add(c)
+        if c.user_id is not None:
+            self._index(c)
+
+    def discard(self, c: "PlatfeConnection"):
+        self._unindex(c)
+        self._connections.discard(c)
+
+    def bind(self, c: "PlatfeConnection", user_id: int, didid: typing.Optional[int]):
+        # переиндексирует соединение после логина
+        self._unindex(c)
+        c.user_id = user_id
+        c.didid = didid
+        if c in self._connections:
+            self._index(c)
+
+    def unbind(self, c: "PlatfeConnection"):
+        self._unindex(c)
+        c.user_id = None
+        c.didid = None
+
+    def by_user(self, user_id: int) -> typing.List["PlatfeConnection"]:
+        return list(self._by_user.get(user_id, ()))
+
+    def by_didid(self, didid: int) -> typing.List["PlatfeConnection"]:
+        return list(self._by_didid.get(didid, ()))
+
+    def authed(self) -> typing.List["PlatfeConnection"]:
+        return [c for c in self._connections if c.authed]
+
+    def _index(self, c: "PlatfeConnection"):
+        self._by_user.setdefault(c.user_id, set()).add(c)
+        if c.didid is not None:
+            self._by_didid.setdefault(c.didid, set()).add(c)
+
+    def _unindex(self, c: "PlatfeConnection"):
+        for index, key in ((self._by_user, c.user_id), (self._by_didid, c.didid)):
+            if key is None:
+                continue
+            bucket = index.get(key)
+            if bucket is None:
+                continue
+            bucket.discard(c)
+            if not bucket:
+                del index[key]
+
+    def __iter__(self):
+        # снимок, чтобы соединения можно было добавлять и удалять во время обхода
+        return iter(list(self._connections))
+
+    def __len__(self):
+        return len(self._connections)
+
+    def __contains__(self, c):
+        return c in self._connections
+
+
+connections = ConnectionHub()